@@ -0,0 +1,148 @@
+from math import floor
+
+from DKWorld import CHUNK_SHIFT, RED
+
+IMP = 0
+
+ENTITYCOLOURS = {
+    IMP : RED
+}
+
+#Entities are drawn as circles of this many tiles around their position
+ENTITY_RADIUS = 0.4
+
+
+class Entity(object):
+    """Something that moves around the world, positioned in tiles."""
+    __slots__ = ('id', 'kind', 'x', 'y', 'tile')
+
+    def __init__(self, entity_id, kind, x, y):
+        self.id = entity_id
+        self.kind = kind
+        self.x = x
+        self.y = y
+        self.tile = (int(floor(x)), int(floor(y)))
+
+    def __repr__(self):
+        return 'Entity({}, {}, {}, {})'.format(self.id, self.kind, self.x, self.y)
+
+    def rect(self):
+        """Get the tiles it covers as (x_min, y_min, x_max, y_max),
+        with exclusive max values.
+        """
+        return (int(floor(self.x - ENTITY_RADIUS)), int(floor(self.y - ENTITY_RADIUS)),
+                int(floor(self.x + ENTITY_RADIUS)) + 1, int(floor(self.y + ENTITY_RADIUS)) + 1)
+
+
+class EntityLayer(object):
+    """Store entities in a spatial hash.
+
+    Each entity is kept under the chunk and the tile it is in, so the
+    entities on screen can be found by only looking at the visible
+    chunks, and the entities under the mouse by only looking at a few
+    tiles. Moving only updates the hash when it goes into a new tile.
+
+    Any areas that changed are recorded in dirty until take_dirty is
+    called, so only those need drawing again.
+    """
+
+    def __init__(self):
+        self.entities = {}
+        self.chunks = {}
+        self.tiles = {}
+        self.dirty = []
+        self.next_id = 0
+
+    def __len__(self):
+        return len(self.entities)
+
+    def __iter__(self):
+        return iter(self.entities.values())
+
+    def _link(self, entity):
+        tile = entity.tile
+        self.tiles.setdefault(tile, []).append(entity)
+        self.chunks.setdefault((tile[0] >> CHUNK_SHIFT, tile[1] >> CHUNK_SHIFT), set()).add(entity)
+
+    def _unlink(self, entity):
+        tile = entity.tile
+        entities = self.tiles[tile]
+        entities.remove(entity)
+        if not entities:
+            del self.tiles[tile]
+        chunk = (tile[0] >> CHUNK_SHIFT, tile[1] >> CHUNK_SHIFT)
+        entities = self.chunks[chunk]
+        entities.discard(entity)
+        if not entities:
+            del self.chunks[chunk]
+
+    def add(self, kind, x, y, entity_id=None):
+        """Create a new entity at a position.
+        The id can be given if it was created somewhere else.
+        """
+        if entity_id is None:
+            entity_id = self.next_id
+        self.next_id = max(self.next_id, entity_id + 1)
+        entity = Entity(entity_id, kind, x, y)
+        self.entities[entity.id] = entity
+        self._link(entity)
+        self.dirty.append(entity.rect())
+        return entity
+
+    def remove(self, entity):
+        del self.entities[entity.id]
+        self._unlink(entity)
+        self.dirty.append(entity.rect())
+
+    def move(self, entity, x, y):
+        """Set the position of an entity."""
+        self.dirty.append(entity.rect())
+        tile = (int(floor(x)), int(floor(y)))
+        if tile != entity.tile:
+            self._unlink(entity)
+            entity.tile = tile
+            self._link(entity)
+        entity.x = x
+        entity.y = y
+        self.dirty.append(entity.rect())
+
+    def take_dirty(self):
+        """Get the areas that changed since the last call, as tile rects."""
+        dirty = self.dirty
+        self.dirty = []
+        return dirty
+
+    def in_rect(self, x_min, y_min, x_max, y_max):
+        """Get the entities that overlap a rectangle of tiles.
+        The values can be floats, and the max values are exclusive.
+        """
+        found = []
+        if not self.chunks:
+            return found
+
+        #Entities can stick out of their own tile
+        x_min -= ENTITY_RADIUS
+        y_min -= ENTITY_RADIUS
+        x_max += ENTITY_RADIUS
+        y_max += ENTITY_RADIUS
+        for chunk_x in range(int(floor(x_min)) >> CHUNK_SHIFT, (int(floor(x_max)) >> CHUNK_SHIFT) + 1):
+            for chunk_y in range(int(floor(y_min)) >> CHUNK_SHIFT, (int(floor(y_max)) >> CHUNK_SHIFT) + 1):
+                for entity in self.chunks.get((chunk_x, chunk_y), ()):
+                    if x_min <= entity.x < x_max and y_min <= entity.y < y_max:
+                        found.append(entity)
+        return found
+
+    def at(self, x, y):
+        """Get the entities covering a point, nearest first.
+        Only the tiles next to the point are checked.
+        """
+        tile_x = int(floor(x))
+        tile_y = int(floor(y))
+        found = []
+        for i in (-1, 0, 1):
+            for j in (-1, 0, 1):
+                for entity in self.tiles.get((tile_x + i, tile_y + j), ()):
+                    distance = (entity.x - x) ** 2 + (entity.y - y) ** 2
+                    if distance <= ENTITY_RADIUS ** 2:
+                        found.append((distance, entity.id, entity))
+        return [entity for distance, entity_id, entity in sorted(found)]
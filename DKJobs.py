@@ -0,0 +1,190 @@
+import heapq
+
+import numpy
+
+from DKWorld import CHUNK_SHIFT, CHUNK_SIZE, CHUNK_MASK
+from DKSelection import TileSelection, mask_array
+
+#Queue entries are (distance, type, item)
+_CHUNK = 0
+_TILES = 1
+
+
+def _chunk_distance(x, y, chunk_x, chunk_y):
+    """Get the lowest distance from a tile to any tile in a chunk."""
+    origin_x = chunk_x << CHUNK_SHIFT
+    origin_y = chunk_y << CHUNK_SHIFT
+    return (max(origin_x - x, 0, x - origin_x - CHUNK_MASK)
+            + max(origin_y - y, 0, y - origin_y - CHUNK_MASK))
+
+
+def _ring(chunk_x, chunk_y, radius):
+    """Get the chunks that are exactly radius chunks away."""
+    if not radius:
+        return [(chunk_x, chunk_y)]
+    chunks = []
+    for i in range(-radius, radius + 1):
+        chunks.append((chunk_x + i, chunk_y - radius))
+        chunks.append((chunk_x + i, chunk_y + radius))
+    for i in range(1 - radius, radius):
+        chunks.append((chunk_x - radius, chunk_y + i))
+        chunks.append((chunk_x + radius, chunk_y + i))
+    return chunks
+
+
+class JobBoard(object):
+    """Tagged blocks waiting to be mined, and the workers doing them.
+
+    The tags are a TileSelection, so the chunk bitmasks act as a grid
+    of buckets. Finding the nearest job only looks at the chunks around
+    the worker, getting further out until nothing closer can exist.
+    """
+
+    def __init__(self, tags=None):
+        """Input the TileSelection of tagged blocks to use, which will
+        be kept up to date by add and remove.
+        """
+        self.tags = TileSelection() if tags is None else tags
+        self.reserved = TileSelection()
+        self.jobs = {}
+        self.workers = {}
+
+    def __len__(self):
+        return len(self.tags)
+
+    def __contains__(self, coordinate):
+        return coordinate in self.tags
+
+    def add(self, selection):
+        """Add tagged blocks."""
+        self.tags |= selection
+
+    def remove(self, selection):
+        """Remove tagged blocks, cancelling any jobs on them.
+        Returns the workers that lost their job.
+        """
+        self.tags -= selection
+        cancelled = []
+        reserved = self.reserved.masks
+        if any(mask & reserved.get(chunk, 0) for chunk, mask in selection.masks.items()):
+            for coordinate, worker in list(self.workers.items()):
+                if coordinate in selection:
+                    self.cancel(worker)
+                    cancelled.append(worker)
+        return cancelled
+
+    def available(self, coordinate):
+        """If a block is tagged and nobody is doing it."""
+        return coordinate in self.tags and coordinate not in self.reserved
+
+    def _available_mask(self, chunk):
+        return self.tags.masks.get(chunk, 0) & ~self.reserved.masks.get(chunk, 0)
+
+    def iter_nearest(self, x, y):
+        """Iterate over the available jobs from nearest to furthest.
+        Yields (distance, coordinate), where the distance is the number
+        of tiles moving up, down, left or right.
+        """
+        chunk_x = x >> CHUNK_SHIFT
+        chunk_y = y >> CHUNK_SHIFT
+        masks = self.tags.masks
+        queue = []
+        radius = 0
+        checked = 0
+        searched_all = False
+        while True:
+
+            #Add the next ring of chunks if anything in it could be closer
+            if not searched_all:
+                ring_distance = max(0, (radius - 1) * CHUNK_SIZE + 1)
+                if not queue or queue[0][0] >= ring_distance:
+                    ring = _ring(chunk_x, chunk_y, radius)
+                    checked += len(ring)
+                    radius += 1
+
+                    #Once more chunks have been checked than exist,
+                    #just go through every chunk that is left
+                    if checked > len(masks):
+                        chunks = [chunk for chunk in masks 
+                                  if max(abs(chunk[0] - chunk_x), abs(chunk[1] - chunk_y)) >= radius - 1]
+                        searched_all = True
+                    else:
+                        chunks = [chunk for chunk in ring if chunk in masks]
+                    for chunk in chunks:
+                        heapq.heappush(queue, (_chunk_distance(x, y, *chunk), _CHUNK, chunk))
+                    continue
+
+            if not queue:
+                return
+            distance, kind, item = heapq.heappop(queue)
+
+            #Sort the tiles of a chunk by distance
+            if kind == _CHUNK:
+                local_x, local_y = numpy.nonzero(mask_array(self._available_mask(item)))
+                if not len(local_x):
+                    continue
+                tiles_x = local_x + (item[0] << CHUNK_SHIFT)
+                tiles_y = local_y + (item[1] << CHUNK_SHIFT)
+                distances = numpy.abs(tiles_x - x) + numpy.abs(tiles_y - y)
+                order = numpy.argsort(distances, kind='stable')
+                tiles = list(zip(distances[order].tolist(), tiles_x[order].tolist(), tiles_y[order].tolist()))
+                heapq.heappush(queue, (tiles[0][0], _TILES, (tiles, 0)))
+                continue
+
+            #Take the nearest tile of a chunk, and queue up the next one
+            tiles, i = item
+            tile = tiles[i][1:]
+            if i + 1 < len(tiles):
+                heapq.heappush(queue, (tiles[i + 1][0], _TILES, (tiles, i + 1)))
+            if self.available(tile):
+                yield distance, tile
+
+    def nearest(self, x, y, accept=None, max_distance=None):
+        """Find the nearest available job.
+        If accept is given, jobs are skipped unless accept(coordinate)
+        is True, such as to check a path exists.
+        Returns None if there are no jobs.
+        """
+        for distance, coordinate in self.iter_nearest(x, y):
+            if max_distance is not None and distance > max_distance:
+                return None
+            if accept is None or accept(coordinate):
+                return coordinate
+        return None
+
+    def reserve(self, worker, coordinate):
+        """Give a job to a worker, replacing any job it already had."""
+        if not self.available(coordinate):
+            raise ValueError('{} is not an available job'.format(coordinate))
+        self.cancel(worker)
+        self.reserved.add(coordinate)
+        self.jobs[worker] = coordinate
+        self.workers[coordinate] = worker
+
+    def assign(self, worker, x, y, accept=None, max_distance=None):
+        """Give the nearest available job to a worker.
+        Returns the coordinate of the job, or None if there wasn't one.
+        """
+        coordinate = self.nearest(x, y, accept, max_distance)
+        if coordinate is not None:
+            self.reserve(worker, coordinate)
+        return coordinate
+
+    def job(self, worker):
+        """Get the job of a worker, or None if it doesn't have one."""
+        return self.jobs.get(worker)
+
+    def cancel(self, worker):
+        """Stop a worker doing its job, so another worker can take it."""
+        coordinate = self.jobs.pop(worker, None)
+        if coordinate is not None:
+            del self.workers[coordinate]
+            self.reserved.discard(coordinate)
+        return coordinate
+
+    def complete(self, worker):
+        """Remove the job of a worker after it's been done."""
+        coordinate = self.cancel(worker)
+        if coordinate is not None:
+            self.tags.discard(coordinate)
+        return coordinate
@@ -1,3 +1,9 @@
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
 def split_decimal_part(n):
     """Split the input into its integral part and its decimal part.
     Returns as string to avoid an error with -0.x.
@@ -20,11 +26,43 @@ def split_decimal_part(n):
         return str(integral) if integral else '0', str(decimal) if decimal else '0'
         
 
-def quick_hash(x, y, offset=10):
-    dx = hash(str(x // 2) + str(y))
-    dy = hash(str((y * x) // 2))
-    num = int(0.5 * (dx + dy) * (dx + dy + 1)) % (offset * 2) - offset
-    return num
+def _mix_hash(h):
+    """Scramble the bits of a 32 bit integer."""
+    h ^= h >> 16
+    h = (h * 0x7FEB352D) & 0xFFFFFFFF
+    h ^= h >> 15
+    h = (h * 0x846CA68B) & 0xFFFFFFFF
+    h ^= h >> 16
+    return h
+
+def quick_hash(x, y, offset=10, seed=0):
+    """Get a random number between -offset and offset for a tile.
+    This is integer only, so it gives the same result on every run and
+    every machine, and coordinates of any size can be used.
+
+    >>> quick_hash(5, -3, offset=15) == quick_hash(5, -3, offset=15)
+    True
+    """
+    h = (x * 0x8DA6B343 + y * 0xD8163841 + seed * 0xCB1AB31F) & 0xFFFFFFFF
+    return _mix_hash(h) % (offset * 2) - offset
+
+def quick_hash_region(x, y, width, height, offset=10, seed=0):
+    """Get the quick_hash values for a rectangle of tiles.
+    Requires numpy, and returns an array indexed by [x, y] relative to
+    the top left corner.
+    """
+    #Only the lower 32 bits matter, so large coordinates can be wrapped
+    #before building the array and the maths will stay in uint32
+    h_x = (numpy.arange(width, dtype=numpy.uint32) + numpy.uint32(x & 0xFFFFFFFF)) * numpy.uint32(0x8DA6B343)
+    h_y = (numpy.arange(height, dtype=numpy.uint32) + numpy.uint32(y & 0xFFFFFFFF)) * numpy.uint32(0xD8163841)
+    h = h_x[:, None] + h_y[None, :] + numpy.uint32((seed * 0xCB1AB31F) & 0xFFFFFFFF)
+    
+    h ^= h >> numpy.uint32(16)
+    h *= numpy.uint32(0x7FEB352D)
+    h ^= h >> numpy.uint32(15)
+    h *= numpy.uint32(0x846CA68B)
+    h ^= h >> numpy.uint32(16)
+    return (h % numpy.uint32(offset * 2)).astype(numpy.int16) - offset
 
 def split_num(n):
     return (int(n), remove_int(n))
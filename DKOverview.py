@@ -0,0 +1,216 @@
+from __future__ import division
+import numpy
+
+from DKWorld import CHUNK_SHIFT, CHUNK_SIZE, TILECOLOURS, TILEMAP, YELLOW, chunk_array
+
+#Cells at the top level of the pyramid are 2 ** MAX_LEVEL tiles wide
+MAX_LEVEL = 16
+
+
+class OverviewPyramid(object):
+    """Counts of each tile type and of tagged tiles, for square cells
+    of 2 ** level tiles, so any area of the world can be drawn at one
+    pixel per cell.
+
+    Levels up to CHUNK_SHIFT are stored as arrays inside each chunk,
+    and anything bigger is a quadtree of chunk totals, so updating a
+    chunk only touches its own arrays and one cell on each level above.
+    Chunks that haven't been loaded are treated as the default tile,
+    and are counted once they are.
+    """
+
+    def __init__(self, tilemap=TILEMAP, tags=None, colours=TILECOLOURS, tag_colour=YELLOW):
+        """Input the TileMap, the TileSelection of tags, the colour of
+        each tile type, and the colour to tint tagged tiles.
+        """
+        self.tilemap = tilemap
+        self.tags = tags
+        self.types = max(colours) + 1
+        self.colours = numpy.zeros((self.types, 3), dtype=numpy.float32)
+        for tile, colour in colours.items():
+            self.colours[tile] = colour
+
+        #Each count adds to the red, green, blue, tiles and tags
+        self.weights = numpy.zeros((self.types + 1, 5), dtype=numpy.float32)
+        self.weights[:self.types, :3] = self.colours
+        self.weights[:self.types, 3] = 1
+        self.weights[self.types, 4] = 1
+        self.tag_colour = numpy.array(tag_colour, dtype=numpy.float32)
+        self.chunk_levels = {}
+        self.nodes = [{} for level in range(MAX_LEVEL + 1)]
+        self.counted = set()
+        self.dirty = set()
+        if tilemap.source is not None:
+            self.dirty.update(tilemap.source.index)
+        if tags is not None:
+            self.dirty.update(tags.masks)
+
+    def invalidate_rect(self, x_min, y_min, x_max, y_max):
+        """Update a rectangle of tiles next time it is used
+        (max values are exclusive).
+        """
+        if x_min >= x_max or y_min >= y_max:
+            return
+        self.invalidate_chunks((chunk_x, chunk_y)
+                               for chunk_x in range(x_min >> CHUNK_SHIFT, ((x_max - 1) >> CHUNK_SHIFT) + 1)
+                               for chunk_y in range(y_min >> CHUNK_SHIFT, ((y_max - 1) >> CHUNK_SHIFT) + 1))
+
+    def invalidate_chunks(self, chunks):
+        self.dirty.update(chunks)
+
+    def _default_counts(self, level):
+        counts = numpy.zeros(self.types + 1, dtype=numpy.int64)
+        counts[self.tilemap.default] = 1 << (level * 2)
+        return counts
+
+    def _chunk_counts(self, chunk_x, chunk_y):
+        """Count the tiles of a chunk for every level up to CHUNK_SHIFT.
+        Returns None if the chunk is all the default tile.
+        """
+        chunk = self.tilemap.get_chunk(chunk_x, chunk_y)
+        tagged = self.tags is not None and (chunk_x, chunk_y) in self.tags.masks
+        if chunk is None and not tagged:
+            return None
+
+        counts = numpy.zeros((CHUNK_SIZE, CHUNK_SIZE, self.types + 1), dtype=numpy.uint16)
+        if chunk is None:
+            counts[:, :, self.tilemap.default] = 1
+        else:
+            tiles = chunk_array(chunk)
+            counts[:, :, :self.types] = tiles[:, :, None] == numpy.arange(self.types)
+        if tagged:
+            counts[:, :, self.types] = self.tags.chunk_array(chunk_x, chunk_y)
+
+        levels = [counts]
+        for level in range(CHUNK_SHIFT):
+            size = CHUNK_SIZE >> (level + 1)
+            levels.append(levels[-1].reshape(size, 2, size, 2, self.types + 1).sum(axis=(1, 3), dtype=numpy.uint16))
+        return levels
+
+    def update(self):
+        """Recount any chunks that changed, and add the difference to
+        the cells above them.
+        """
+        self.dirty.update(chunk for chunk in list(self.tilemap.chunks) if chunk not in self.counted)
+        for chunk in self.dirty:
+            self.counted.add(chunk)
+            levels = self._chunk_counts(*chunk)
+            old = self.nodes[CHUNK_SHIFT].get(chunk, self._default_counts(CHUNK_SHIFT))
+            if levels is None:
+                self.chunk_levels.pop(chunk, None)
+                self.nodes[CHUNK_SHIFT].pop(chunk, None)
+                new = self._default_counts(CHUNK_SHIFT)
+            else:
+                self.chunk_levels[chunk] = levels[1:CHUNK_SHIFT]
+                new = levels[CHUNK_SHIFT][0, 0].astype(numpy.int64)
+                self.nodes[CHUNK_SHIFT][chunk] = new
+            difference = new - old
+            if not difference.any():
+                continue
+
+            key_x, key_y = chunk
+            for level in range(CHUNK_SHIFT + 1, MAX_LEVEL + 1):
+                key_x >>= 1
+                key_y >>= 1
+                nodes = self.nodes[level]
+                counts = nodes.get((key_x, key_y), self._default_counts(level)) + difference
+                if (counts == self._default_counts(level)).all():
+                    del nodes[(key_x, key_y)]
+                else:
+                    nodes[(key_x, key_y)] = counts
+        self.dirty = set()
+
+    def counts(self, level, x, y, width, height):
+        """Get the counts of a rectangle of cells, as an array indexed
+        by [x, y, type], where the last type is the number of tags.
+        """
+        return self._counts(level, x, y, width, height)[0]
+
+    def _counts(self, level, x, y, width, height):
+        """Get the counts of a rectangle of cells, and a bool array of
+        which cells aren't just the default tile.
+        """
+        self.update()
+        counts = numpy.zeros((width, height, self.types + 1), dtype=numpy.int64)
+        counts[:, :] = self._default_counts(level)
+        filled = numpy.zeros((width, height), dtype=bool)
+
+        #Build from the tiles
+        if not level:
+            tiles = self.tilemap.get_tile_region(x, y, width, height)
+            counts[:, :, :self.types] = tiles[:, :, None] == numpy.arange(self.types)
+            if self.tags is not None:
+                counts[:, :, self.types] = self.tags.region_array(x, y, width, height)
+            filled[:] = True
+
+        #Copy from the chunks
+        elif level < CHUNK_SHIFT:
+            shift = CHUNK_SHIFT - level
+            size = 1 << shift
+            x_max = x + width
+            y_max = y + height
+            chunk_range_x = range(x >> shift, ((x_max - 1) >> shift) + 1)
+            chunk_range_y = range(y >> shift, ((y_max - 1) >> shift) + 1)
+            if len(self.chunk_levels) < len(chunk_range_x) * len(chunk_range_y):
+                chunks = [chunk for chunk in self.chunk_levels
+                          if chunk[0] in chunk_range_x and chunk[1] in chunk_range_y]
+            else:
+                chunks = [(chunk_x, chunk_y) for chunk_x in chunk_range_x for chunk_y in chunk_range_y
+                          if (chunk_x, chunk_y) in self.chunk_levels]
+            for chunk_x, chunk_y in chunks:
+                cells = self.chunk_levels[(chunk_x, chunk_y)][level - 1]
+                origin_x = chunk_x << shift
+                origin_y = chunk_y << shift
+                x1 = max(x, origin_x)
+                y1 = max(y, origin_y)
+                x2 = min(x_max, origin_x + size)
+                y2 = min(y_max, origin_y + size)
+                counts[x1 - x:x2 - x, y1 - y:y2 - y] = cells[x1 - origin_x:x2 - origin_x,
+                                                             y1 - origin_y:y2 - origin_y]
+                filled[x1 - x:x2 - x, y1 - y:y2 - y] = True
+
+        #Look up the quadtree, going through whichever is smaller
+        else:
+            nodes = self.nodes[level]
+            if len(nodes) < width * height:
+                for (node_x, node_y), node in nodes.items():
+                    if x <= node_x < x + width and y <= node_y < y + height:
+                        counts[node_x - x, node_y - y] = node
+                        filled[node_x - x, node_y - y] = True
+            else:
+                for i in range(width):
+                    for j in range(height):
+                        node = nodes.get((x + i, y + j))
+                        if node is not None:
+                            counts[i, j] = node
+                            filled[i, j] = True
+        return counts, filled
+
+    def render(self, level, x, y, width, height, dominant=False):
+        """Get the colours of a rectangle of cells as an RGB array
+        indexed by [x, y], for use with surfarray.
+
+        Each cell is the average colour of its tiles, or the colour of
+        the most common tile if dominant is set, tinted by how many of
+        its tiles are tagged.
+        """
+        counts, filled = self._counts(level, x, y, width, height)
+        colours = numpy.empty((width, height, 3), dtype=numpy.uint8)
+        colours[:, :] = self._colours(self._default_counts(level)[None], dominant)[0]
+        colours[filled] = self._colours(counts[filled], dominant)
+        return colours
+
+    def _colours(self, counts, dominant):
+        """Get the colours of a list of cell counts."""
+        counts = counts.astype(numpy.float32)
+
+        #Add up the colours, tiles and tags in one go
+        sums = counts.dot(self.weights)
+        total = numpy.maximum(sums[:, 3], 1)
+        if dominant:
+            colours = self.colours[counts[:, :self.types].argmax(axis=1)]
+        else:
+            colours = sums[:, :3] / total[:, None]
+        tagged = sums[:, 4] / total * 0.5
+        colours += (self.tag_colour - colours) * tagged[:, None]
+        return colours.astype(numpy.uint8)
@@ -0,0 +1,323 @@
+import heapq
+from collections import OrderedDict, deque
+
+import numpy
+
+from DKWorld import CHUNK_SHIFT, CHUNK_SIZE, CHUNK_MASK, GRASS, TILEMAP
+
+PASSABLE = (GRASS,)
+
+#Border openings at least this long get an entrance at each end
+#instead of one in the middle
+ENTRANCE_SPLIT = 6
+
+
+def _local_index(x, y):
+    return (x & CHUNK_MASK) << CHUNK_SHIFT | (y & CHUNK_MASK)
+
+
+def _bfs(passable, start, targets=None):
+    """Find the distance to every reachable tile in a chunk.
+    passable is a list indexed the same as TileChunk, and start is a
+    local index. If targets are given, it stops once they are all found.
+
+    Returns the distances and the previous tile of each tile.
+    """
+    distances = {start: 0}
+    previous = {start: None}
+    remaining = set(targets) if targets is not None else None
+    if remaining is not None:
+        remaining.discard(start)
+    queue = deque([start])
+    while queue:
+        if remaining is not None and not remaining:
+            break
+        i = queue.popleft()
+        distance = distances[i] + 1
+        local_x = i >> CHUNK_SHIFT
+        local_y = i & CHUNK_MASK
+        for neighbour, valid in ((i - CHUNK_SIZE, local_x > 0),
+                                 (i + CHUNK_SIZE, local_x < CHUNK_MASK),
+                                 (i - 1, local_y > 0),
+                                 (i + 1, local_y < CHUNK_MASK)):
+            if valid and neighbour not in distances and passable[neighbour]:
+                distances[neighbour] = distance
+                previous[neighbour] = i
+                queue.append(neighbour)
+                if remaining is not None:
+                    remaining.discard(neighbour)
+    return distances, previous
+
+
+class ChunkGraph(object):
+    """Entrances of a chunk and the distances between them.
+
+    An entrance is a tile next to a passable tile in a neighbouring
+    chunk. Each one is linked to the tile over the border, and to every
+    other entrance it can reach without leaving the chunk.
+    """
+    __slots__ = ('x', 'y', 'passable', 'nodes', 'edges', 'links', 'segments')
+
+    def __init__(self, x, y, passable):
+        """Input the chunk coordinates and a numpy bool array of which
+        tiles are passable, covering the chunk plus 1 tile around it.
+        """
+        self.x = x
+        self.y = y
+        self.passable = passable[1:-1, 1:-1].ravel().tolist()
+        self.links = {}
+        self.segments = {}
+        origin_x = x << CHUNK_SHIFT
+        origin_y = y << CHUNK_SHIFT
+
+        #Find the openings along each side
+        for side, inside, outside, offset in (
+                ((origin_x, origin_y), passable[1, 1:-1], passable[0, 1:-1], (-1, 0)),
+                ((origin_x + CHUNK_MASK, origin_y), passable[-2, 1:-1], passable[-1, 1:-1], (1, 0)),
+                ((origin_x, origin_y), passable[1:-1, 1], passable[1:-1, 0], (0, -1)),
+                ((origin_x, origin_y + CHUNK_MASK), passable[1:-1, -2], passable[1:-1, -1], (0, 1))):
+            horizontal = offset[0] == 0
+            for start, end in self._openings(inside & outside):
+                entrances = [(start + end) // 2] if end - start < ENTRANCE_SPLIT else [start, end - 1]
+                for i in entrances:
+                    node = (side[0] + i, side[1]) if horizontal else (side[0], side[1] + i)
+                    self.links.setdefault(node, []).append((node[0] + offset[0], node[1] + offset[1]))
+
+        #Connect the entrances inside the chunk
+        self.nodes = list(self.links)
+        indexes = {_local_index(*node): node for node in self.nodes}
+        self.edges = {}
+        for node in self.nodes:
+            distances = _bfs(self.passable, _local_index(*node), indexes)[0]
+            self.edges[node] = [(indexes[i], distances[i]) for i in indexes
+                                if i in distances and indexes[i] != node]
+
+    @staticmethod
+    def _openings(line):
+        """Get the (start, end) of each run of True values."""
+        openings = []
+        start = None
+        for i, value in enumerate(line.tolist()):
+            if value and start is None:
+                start = i
+            elif not value and start is not None:
+                openings.append((start, i))
+                start = None
+        if start is not None:
+            openings.append((start, len(line)))
+        return openings
+
+    def is_passable(self, x, y):
+        return self.passable[_local_index(x, y)]
+
+    def distances(self, x, y):
+        """Get the distance from a tile to each entrance it can reach."""
+        indexes = {_local_index(*node): node for node in self.nodes}
+        distances, previous = _bfs(self.passable, _local_index(x, y), indexes)
+        return {indexes[i]: distances[i] for i in indexes if i in distances}
+
+    def segment(self, start, end):
+        """Get the tiles from start to end without leaving the chunk,
+        not including start. Returns None if there is no path.
+        """
+        key = (start, end)
+        try:
+            return self.segments[key]
+        except KeyError:
+            pass
+
+        target = _local_index(*end)
+        distances, previous = _bfs(self.passable, _local_index(*start), (target,))
+        if target not in distances:
+            path = None
+        else:
+            origin_x = self.x << CHUNK_SHIFT
+            origin_y = self.y << CHUNK_SHIFT
+            path = []
+            i = target
+            while previous[i] is not None:
+                path.append((origin_x + (i >> CHUNK_SHIFT), origin_y + (i & CHUNK_MASK)))
+                i = previous[i]
+            path.reverse()
+        self.segments[key] = path
+        return path
+
+
+class Pathfinder(object):
+    """Hierarchical pathfinding over a TileMap.
+
+    The world is split into chunks, and a path is first found between
+    chunk entrances, which is then turned into tiles a chunk at a time
+    as it gets followed. Chunk graphs are only built when a search
+    reaches them, and are thrown away when a tile in or next to the
+    chunk changes, along with any cached paths that used them.
+    """
+
+    def __init__(self, tilemap=TILEMAP, passable=PASSABLE, max_paths=1024, max_nodes=20000):
+        """Input the TileMap, which tiles can be walked on, how many
+        paths to cache, and how many entrances a search can visit
+        before giving up.
+        """
+        self.tilemap = tilemap
+        self.passable = numpy.array(sorted(passable), dtype=numpy.uint8)
+        self.max_paths = max_paths
+        self.max_nodes = max_nodes
+        self.graphs = {}
+        self.paths = OrderedDict()
+        self.chunk_paths = {}
+
+    def graph(self, chunk_x, chunk_y):
+        """Get the graph of a chunk, building it if required."""
+        try:
+            return self.graphs[(chunk_x, chunk_y)]
+        except KeyError:
+            tiles = self.tilemap.get_tile_region((chunk_x << CHUNK_SHIFT) - 1, (chunk_y << CHUNK_SHIFT) - 1,
+                                                 CHUNK_SIZE + 2, CHUNK_SIZE + 2)
+            graph = self.graphs[(chunk_x, chunk_y)] = ChunkGraph(chunk_x, chunk_y, numpy.isin(tiles, self.passable))
+            return graph
+
+    def is_passable(self, x, y):
+        return self.graph(x >> CHUNK_SHIFT, y >> CHUNK_SHIFT).is_passable(x, y)
+
+    def invalidate_rect(self, x_min, y_min, x_max, y_max):
+        """Forget everything that depends on a rectangle of tiles
+        (max values are exclusive), after they have been edited.
+        The chunks around it are included as their entrances may change.
+        """
+        if x_min >= x_max or y_min >= y_max:
+            return
+        for chunk_x in range((x_min - 1) >> CHUNK_SHIFT, (x_max >> CHUNK_SHIFT) + 1):
+            for chunk_y in range((y_min - 1) >> CHUNK_SHIFT, (y_max >> CHUNK_SHIFT) + 1):
+                self.invalidate(chunk_x, chunk_y)
+
+    def invalidate(self, chunk_x, chunk_y):
+        """Forget the graph of a chunk and every path that used it."""
+        self.graphs.pop((chunk_x, chunk_y), None)
+        for key in self.chunk_paths.pop((chunk_x, chunk_y), ()):
+            self._remove_path(key)
+
+    def _remove_path(self, key):
+        try:
+            waypoints, chunks = self.paths.pop(key)
+        except KeyError:
+            return
+        for chunk in chunks:
+            keys = self.chunk_paths.get(chunk)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.chunk_paths[chunk]
+
+    def _add_path(self, key, waypoints, chunks):
+        self.paths[key] = (waypoints, chunks)
+        for chunk in chunks:
+            self.chunk_paths.setdefault(chunk, set()).add(key)
+        while len(self.paths) > self.max_paths:
+            self._remove_path(next(iter(self.paths)))
+
+    def find_path(self, start, goal):
+        """Find a path between two tiles.
+        Returns a list of waypoints from start to goal, which can be
+        turned into tiles with steps, or None if there is no path.
+        If the search gives up after max_nodes, None is returned but
+        not cached, since the chunks it didn't reach may have a path.
+        """
+        key = (start, goal)
+        try:
+            waypoints, chunks = self.paths.pop(key)
+        except KeyError:
+            waypoints, chunks = self._search(start, goal)
+            if chunks is not None:
+                self._add_path(key, waypoints, chunks)
+        else:
+            self.paths[key] = (waypoints, chunks)
+        return None if waypoints is None else list(waypoints)
+
+    def _search(self, start, goal):
+        """A* search over the chunk entrances.
+        Returns the waypoints and the chunks that were looked at, or
+        (None, None) if it gave up before finishing.
+        """
+        start_chunk = (start[0] >> CHUNK_SHIFT, start[1] >> CHUNK_SHIFT)
+        goal_chunk = (goal[0] >> CHUNK_SHIFT, goal[1] >> CHUNK_SHIFT)
+        chunks = {start_chunk, goal_chunk}
+        start_graph = self.graph(*start_chunk)
+        goal_graph = self.graph(*goal_chunk)
+        if not start_graph.is_passable(*start) or not goal_graph.is_passable(*goal):
+            return None, chunks
+        if start == goal:
+            return [start], chunks
+
+        #Connect the start and goal to their own chunks
+        start_edges = list(start_graph.distances(*start).items())
+        goal_edges = goal_graph.distances(*goal)
+        if start_chunk == goal_chunk:
+            path = start_graph.segment(start, goal)
+            if path is not None:
+                start_edges.append((goal, len(path)))
+
+        goal_x, goal_y = goal
+        def heuristic(node):
+            return abs(node[0] - goal_x) + abs(node[1] - goal_y)
+
+        costs = {start: 0}
+        previous = {start: None}
+        queue = [(heuristic(start), 0, start)]
+        visited = 0
+        while queue:
+            estimate, cost, node = heapq.heappop(queue)
+            if node == goal:
+                break
+            if cost > costs[node]:
+                continue
+            visited += 1
+            if visited > self.max_nodes:
+                return None, None
+
+            if node == start:
+                neighbours = start_edges + [(link, 1) for link in start_graph.links.get(start, ())]
+            else:
+                chunk = (node[0] >> CHUNK_SHIFT, node[1] >> CHUNK_SHIFT)
+                chunks.add(chunk)
+                graph = self.graph(*chunk)
+                neighbours = graph.edges[node] + [(link, 1) for link in graph.links[node]]
+                if node in goal_edges:
+                    neighbours.append((goal, goal_edges[node]))
+
+            for neighbour, distance in neighbours:
+                new_cost = cost + distance
+                if new_cost < costs.get(neighbour, new_cost + 1):
+                    costs[neighbour] = new_cost
+                    previous[neighbour] = node
+                    heapq.heappush(queue, (new_cost + heuristic(neighbour), new_cost, neighbour))
+        else:
+            return None, chunks
+
+        waypoints = []
+        node = goal
+        while node is not None:
+            waypoints.append(node)
+            node = previous[node]
+        waypoints.reverse()
+        return waypoints, chunks
+
+    def steps(self, waypoints):
+        """Iterate over the tiles of a path, not including the start.
+        Each part is only worked out when it is reached.
+        """
+        for start, end in zip(waypoints, waypoints[1:]):
+            if abs(start[0] - end[0]) + abs(start[1] - end[1]) == 1:
+                yield end
+                continue
+            graph = self.graph(start[0] >> CHUNK_SHIFT, start[1] >> CHUNK_SHIFT)
+            for step in graph.segment(start, end) or ():
+                yield step
+
+    def find_tiles(self, start, goal):
+        """Find a path between two tiles as a list of every tile after
+        the start, or None if there is no path.
+        """
+        waypoints = self.find_path(start, goal)
+        if waypoints is None:
+            return None
+        return list(self.steps(waypoints))
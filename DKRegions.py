@@ -0,0 +1,248 @@
+import numpy
+
+from DKPath import PASSABLE
+from DKWorld import CHUNK_SHIFT, CHUNK_SIZE, CHUNK_MASK, TILEMAP
+
+
+def _label(passable):
+    """Label the connected areas of a chunk, going through each column
+    as runs of passable tiles and joining runs that touch.
+    Returns an int array indexed by [x, y] where impassable tiles are -1,
+    and the number of labels.
+    """
+    labels = numpy.full(passable.shape, -1, dtype=numpy.int32)
+    parent = []
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    previous = []
+    for x in range(passable.shape[0]):
+        edges = numpy.flatnonzero(numpy.diff(numpy.concatenate(([0], passable[x].view(numpy.int8), [0])))).tolist()
+        runs = []
+        for start, end in zip(edges[::2], edges[1::2]):
+            label = len(parent)
+            parent.append(label)
+            for previous_start, previous_end, previous_label in previous:
+                if previous_start < end and start < previous_end:
+                    parent[find(previous_label)] = label
+            labels[x, start:end] = label
+            runs.append((start, end, label))
+        previous = runs
+
+    #Number the areas from 0
+    roots = [find(i) for i in range(len(parent))]
+    numbers = {}
+    mapping = numpy.array([numbers.setdefault(root, len(numbers)) for root in roots] + [-1], dtype=numpy.int32)
+    return mapping[labels], len(numbers)
+
+
+class RegionIndex(object):
+    """Which passable tiles are connected to each other.
+
+    Each chunk labels its own connected areas, and every label gets an
+    id in a union-find, which joins the labels that touch across chunk
+    borders. Two tiles are connected if their ids have the same root.
+
+    Chunks are labelled when a query needs them, and a search only
+    spreads into the chunks a region actually touches, so regions that
+    have been fully explored are marked as closed and answer straight
+    away. When tiles change, only their chunks are labelled again. New
+    passable tiles just join ids together, but if any were removed the
+    union-find is rebuilt from the chunk borders on the next query,
+    which doesn't need to look at any tiles.
+    """
+
+    def __init__(self, tilemap=TILEMAP, passable=PASSABLE, max_chunks=4096):
+        """Input the TileMap, which tiles can be walked on, and how many
+        chunks a search can label before giving up.
+        """
+        self.tilemap = tilemap
+        self.passable = numpy.array(sorted(passable), dtype=numpy.uint8)
+        self.max_chunks = max_chunks
+        self.chunks = {}
+        self.parent = {}
+        self.next_id = 0
+        self.closed = set()
+        self.stale = False
+
+    def _find(self, i):
+        parent = self.parent
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def _union(self, a, b):
+        a = self._find(a)
+        b = self._find(b)
+        if a != b:
+            self.parent[a] = b
+
+    def _new_ids(self, count):
+        base = self.next_id
+        self.next_id += count
+        for i in range(base, self.next_id):
+            self.parent[i] = i
+        return base
+
+    def _label_chunk(self, chunk_x, chunk_y):
+        """Label the tiles of a chunk with new ids.
+        Returns (labels, base), where the id of a label is base + label.
+        """
+        tiles = self.tilemap.get_tile_region(chunk_x << CHUNK_SHIFT, chunk_y << CHUNK_SHIFT, CHUNK_SIZE, CHUNK_SIZE)
+        labels, count = _label(numpy.isin(tiles, self.passable))
+        return labels, self._new_ids(count)
+
+    def _join_borders(self, chunk_x, chunk_y):
+        """Join the ids of a chunk to the ids of its labelled neighbours."""
+        labels, base = self.chunks[(chunk_x, chunk_y)]
+        for neighbour, inside, outside in (((chunk_x - 1, chunk_y), (0, slice(None)), (-1, slice(None))),
+                                           ((chunk_x + 1, chunk_y), (-1, slice(None)), (0, slice(None))),
+                                           ((chunk_x, chunk_y - 1), (slice(None), 0), (slice(None), -1)),
+                                           ((chunk_x, chunk_y + 1), (slice(None), -1), (slice(None), 0))):
+            try:
+                neighbour_labels, neighbour_base = self.chunks[neighbour]
+            except KeyError:
+                continue
+            a = labels[inside]
+            b = neighbour_labels[outside]
+            touching = (a >= 0) & (b >= 0)
+            for label, neighbour_label in set(zip(a[touching].tolist(), b[touching].tolist())):
+                self._union(base + label, neighbour_base + neighbour_label)
+
+    def _chunk(self, chunk_x, chunk_y):
+        """Get the labels and base id of a chunk, labelling it if required."""
+        try:
+            return self.chunks[(chunk_x, chunk_y)]
+        except KeyError:
+            self.chunks[(chunk_x, chunk_y)] = self._label_chunk(chunk_x, chunk_y)
+            self._join_borders(chunk_x, chunk_y)
+            return self.chunks[(chunk_x, chunk_y)]
+
+    def _rebuild(self):
+        """Start the union-find again from the labelled chunks."""
+        self.parent = {}
+        for labels, base in self.chunks.values():
+            for i in range(base, base + int(labels.max()) + 1):
+                self.parent[i] = i
+        for chunk_x, chunk_y in self.chunks:
+            self._join_borders(chunk_x, chunk_y)
+        self.stale = False
+
+    def invalidate_rect(self, x_min, y_min, x_max, y_max):
+        """Label a rectangle of tiles again (max values are exclusive),
+        after they have been edited.
+        """
+        if x_min >= x_max or y_min >= y_max:
+            return
+        for chunk_x in range(x_min >> CHUNK_SHIFT, ((x_max - 1) >> CHUNK_SHIFT) + 1):
+            for chunk_y in range(y_min >> CHUNK_SHIFT, ((y_max - 1) >> CHUNK_SHIFT) + 1):
+                self.invalidate(chunk_x, chunk_y)
+
+    def invalidate(self, chunk_x, chunk_y):
+        """Label a chunk again after it was edited.
+        Chunks that haven't been labelled yet are left until needed.
+        """
+        try:
+            old_labels, old_base = self.chunks[(chunk_x, chunk_y)]
+        except KeyError:
+            return
+        labels, base = self.chunks[(chunk_x, chunk_y)] = self._label_chunk(chunk_x, chunk_y)
+        self.closed = set()
+        was_passable = old_labels >= 0
+        if self.stale or (was_passable & (labels < 0)).any():
+            self.stale = True
+            return
+
+        #Nothing was removed, so each old label is part of a new one
+        for old_label, label in set(zip(old_labels[was_passable].tolist(), labels[was_passable].tolist())):
+            self._union(old_base + old_label, base + label)
+        self._join_borders(chunk_x, chunk_y)
+
+    def _id(self, x, y):
+        labels, base = self._chunk(x >> CHUNK_SHIFT, y >> CHUNK_SHIFT)
+        label = labels[x & CHUNK_MASK, y & CHUNK_MASK]
+        if label < 0:
+            return None
+        return base + int(label)
+
+    def _explore(self, chunk, i, goal=None):
+        """Label every chunk the region of an id touches, starting from
+        the chunk the id is in, until it is joined to the goal id.
+        Returns True if it was joined to the goal.
+        """
+        chunks = [chunk]
+        searched = {chunk}
+        labelled = 0
+        while chunks:
+            chunk_x, chunk_y = chunks.pop()
+            labels, base = self.chunks[(chunk_x, chunk_y)]
+            root = self._find(i)
+            for neighbour, side in (((chunk_x - 1, chunk_y), labels[0]),
+                                    ((chunk_x + 1, chunk_y), labels[-1]),
+                                    ((chunk_x, chunk_y - 1), labels[:, 0]),
+                                    ((chunk_x, chunk_y + 1), labels[:, -1])):
+                if neighbour in searched:
+                    continue
+                if not any(self._find(base + label) == root for label in set(side[side >= 0].tolist())):
+                    continue
+                if neighbour not in self.chunks:
+                    labelled += 1
+                    if labelled > self.max_chunks:
+                        return False
+                self._chunk(*neighbour)
+                root = self._find(i)
+                if goal is not None and self._find(goal) == root:
+                    return True
+
+                #Carry on if the region went into it
+                neighbour_labels, neighbour_base = self.chunks[neighbour]
+                ids = set(neighbour_labels[neighbour_labels >= 0].tolist())
+                if any(self._find(neighbour_base + label) == root for label in ids):
+                    searched.add(neighbour)
+                    chunks.append(neighbour)
+
+        self.closed.add(self._find(i))
+        return False
+
+    def region(self, x, y):
+        """Get an id of the region a tile is in, or None if it isn't
+        passable. Tiles in the same region are connected, but the id
+        can change after more of the region is found or tiles change.
+        """
+        if self.stale:
+            self._rebuild()
+        i = self._id(x, y)
+        if i is None:
+            return None
+        return self._find(i)
+
+    def connected(self, start, goal):
+        """If there is a path between two passable tiles."""
+        if self.stale:
+            self._rebuild()
+        a = self._id(*start)
+        b = self._id(*goal)
+        if a is None or b is None:
+            return False
+        a_root = self._find(a)
+        b_root = self._find(b)
+        if a_root == b_root:
+            return True
+        if a_root in self.closed or b_root in self.closed:
+            return False
+        return self._explore((start[0] >> CHUNK_SHIFT, start[1] >> CHUNK_SHIFT), a, b)
+
+    def can_reach(self, start, coordinate):
+        """If a tile can be walked to or stood next to from start, such
+        as a block to mine.
+        """
+        x, y = coordinate
+        for tile in ((x, y), (x - 1, y), (x + 1, y), (x, y - 1), (x, y + 1)):
+            if self.connected(start, tile):
+                return True
+        return False
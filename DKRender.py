@@ -0,0 +1,557 @@
+import threading
+import time
+import traceback
+from collections import OrderedDict
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import numpy
+import pygame
+
+from DKWorld import CHUNK_SHIFT, CHUNK_SIZE
+
+#Largest width in pixels of a cached surface
+SECTION_MAX_SIZE = 512
+
+#Tag states used by the palette
+TAG_NONE = 0
+TAG_TEMP = 1
+TAG_SET = 2
+
+
+def section_span(tilesize):
+    """Get how many tiles wide a cached section is at a tile size.
+
+    A whole chunk is used if possible, but large tiles would create
+    huge surfaces, so the chunk is split into a power of 2 sections.
+    """
+    span = CHUNK_SIZE
+    while span > 1 and span * tilesize > SECTION_MAX_SIZE:
+        span >>= 1
+    return span
+
+
+class TilePalette(object):
+    """Lookup table of the colour for every tile type, noise value and
+    tag state, so a whole region can be coloured in one numpy call.
+    """
+
+    def __init__(self, tile_colours, noise_level, tag_colours):
+        """Input the {tile: colour} dict, the noise offset used by
+        quick_hash, and the colours to mix in for each tag state, in
+        the order TAG_NONE, TAG_TEMP, TAG_SET (None for no mix).
+        """
+        self.noise_level = noise_level
+        
+        base = numpy.zeros((max(tile_colours) + 1, 3), dtype=int)
+        for tile, colour in tile_colours.items():
+            base[tile] = colour
+        noise = numpy.arange(-noise_level, noise_level)
+        plain = numpy.clip(base[:, None, :] + noise[None, :, None], 0, 255)
+        
+        self.table = numpy.empty(plain.shape[:2] + (len(tag_colours), 3), dtype=numpy.uint8)
+        for i, colour_mix in enumerate(tag_colours):
+            if colour_mix is None:
+                self.table[:, :, i] = plain
+            else:
+                self.table[:, :, i] = (plain + numpy.array(colour_mix) * 15) // 16
+
+    def colours(self, tiles, noise, tags):
+        """Convert arrays of tiles, noise and tag states to an array
+        of RGB colours with an extra dimension on the end.
+        """
+        return self.table[tiles, noise + self.noise_level, tags]
+
+    def render(self, tiles, noise, tags, tilesize, screen=None):
+        """Draw a region of tiles to a new surface.
+
+        Each tile is first drawn as a single pixel, then the whole
+        surface is scaled up to the tile size.
+        """
+        width, height = tiles.shape
+        if screen is None:
+            small = pygame.Surface((width, height))
+        else:
+            small = pygame.Surface((width, height), 0, screen)
+        pygame.surfarray.blit_array(small, self.colours(tiles, noise, tags))
+        return pygame.transform.scale(small, (width * tilesize, height * tilesize))
+
+
+class ChunkSurfaceCache(object):
+    """Store pre-rendered chunk surfaces, removing the least recently
+    used ones when going over the memory budget.
+
+    The keys are tuples starting with the chunk coordinates, and the
+    full key is passed to the render function when it's not cached.
+    """
+
+    def __init__(self, render, max_bytes=64 * 1024 * 1024):
+        """Input the render function and the memory budget in bytes."""
+        self.render = render
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        self.surfaces = OrderedDict()
+        self.chunk_keys = {}
+        self.versions = {}
+
+    def __len__(self):
+        return len(self.surfaces)
+
+    def __contains__(self, key):
+        return key in self.surfaces
+
+    def get(self, *key):
+        """Get a surface, rendering it if required."""
+        try:
+            surface = self.surfaces.pop(key)
+        except KeyError:
+            surface = self.render(*key)
+            self._add(key, surface)
+        else:
+            self.surfaces[key] = surface
+        return surface
+
+    def put(self, key, surface):
+        """Store a surface that was rendered elsewhere."""
+        if key in self.surfaces:
+            self._remove(key)
+        self._add(key, surface)
+
+    def version(self, chunk_x, chunk_y):
+        """Get how many times a chunk has been invalidated, so anything
+        rendered in the meantime can be recognised as out of date.
+        """
+        return self.versions.get((chunk_x, chunk_y), 0)
+
+    def _add(self, key, surface):
+        self.surfaces[key] = surface
+        self.chunk_keys.setdefault(key[:2], set()).add(key)
+        self.used_bytes += self._size(surface)
+
+        #Remove old surfaces, but always keep the latest one
+        while self.used_bytes > self.max_bytes and len(self.surfaces) > 1:
+            self._remove(next(iter(self.surfaces)))
+
+    def _remove(self, key):
+        surface = self.surfaces.pop(key)
+        self.used_bytes -= self._size(surface)
+        chunk_keys = self.chunk_keys[key[:2]]
+        chunk_keys.discard(key)
+        if not chunk_keys:
+            del self.chunk_keys[key[:2]]
+
+    @staticmethod
+    def _size(surface):
+        width, height = surface.get_size()
+        return width * height * surface.get_bytesize()
+
+    def invalidate(self, chunk_x, chunk_y):
+        """Remove every surface belonging to a chunk."""
+        self.versions[(chunk_x, chunk_y)] = self.version(chunk_x, chunk_y) + 1
+        for key in tuple(self.chunk_keys.get((chunk_x, chunk_y), ())):
+            self._remove(key)
+
+    def invalidate_tiles(self, coordinates):
+        """Remove the surfaces of all chunks containing the tiles."""
+        chunks = set((x >> CHUNK_SHIFT, y >> CHUNK_SHIFT) for x, y in coordinates)
+        for chunk in chunks:
+            self.invalidate(*chunk)
+
+    def clear(self):
+        self.surfaces.clear()
+        self.chunk_keys.clear()
+        self.used_bytes = 0
+
+
+class ChunkGenerator(object):
+    """Render chunk sections in a background thread.
+
+    The wanted sections are set with request, and finished ones are
+    added to the cache with collect, so the main loop never has to
+    wait for them.
+    """
+
+    def __init__(self, cache, render):
+        """Input the ChunkSurfaceCache and the function to render a
+        section, which will be called from the thread, so it mustn't
+        use anything the main thread may replace, such as the screen.
+        """
+        self.cache = cache
+        self.render = render
+        self.requests = queue.Queue()
+        self.results = queue.Queue()
+        self.pending = set()
+        self.wanted = set()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            key, version = self.requests.get()
+            if key is None:
+                return
+            
+            #Skip anything that is no longer needed
+            surface = None
+            if key in self.wanted:
+                
+                #Keep the thread alive, the section will be asked for again
+                try:
+                    surface = self.render(*key)
+                except Exception:
+                    traceback.print_exc()
+            self.results.put((key, version, surface))
+
+    def request(self, keys):
+        """Set which sections are wanted, replacing any old requests."""
+        self.wanted = set(keys)
+        for key in self.wanted:
+            if key not in self.pending and key not in self.cache:
+                self.pending.add(key)
+                self.requests.put((key, self.cache.version(*key[:2])))
+
+    def collect(self):
+        """Add any finished sections to the cache.
+        Returns the keys that were added.
+        """
+        added = []
+        while True:
+            try:
+                key, version, surface = self.results.get_nowait()
+            except queue.Empty:
+                return added
+            self.pending.discard(key)
+            
+            #Ignore it if the chunk was edited after the request
+            if surface is not None and version == self.cache.version(*key[:2]):
+                self.cache.put(key, surface)
+                added.append(key)
+
+    def stop(self):
+        self.requests.put((None, None))
+
+
+class ZoomLevels(object):
+    """Layers of the world pre-rendered at a few tile sizes, usually
+    powers of 2, so zooming only needs to scale an existing layer.
+
+    Each layer covers what can be seen at its own tile size plus a
+    margin, and the nearest smaller layer is used, so a layer covers
+    the screen at any tile size until the next level.
+    """
+
+    def __init__(self, render_region, tilesizes, margin=0.25):
+        """Input the region render function, the tile sizes to keep
+        layers for, and how much extra to draw around each layer.
+        """
+        self.render_region = render_region
+        self.tilesizes = sorted(tilesizes)
+        self.margin = margin
+        self.layers = {}
+
+    def clear(self):
+        self.layers = {}
+
+    def nearest(self, tilesize):
+        """Get the largest level that isn't bigger than the tile size."""
+        level = self.tilesizes[0]
+        for i in self.tilesizes:
+            if i > tilesize:
+                break
+            level = i
+        return level
+
+    def _render_layer(self, level, x_min, y_min, x_max, y_max, size):
+        """Draw a new layer around the visible tiles."""
+        width = max(size[0] // level + 2, x_max - x_min)
+        height = max(size[1] // level + 2, y_max - y_min)
+        width += int(width * self.margin) * 2
+        height += int(height * self.margin) * 2
+        x = (x_min + x_max) // 2 - width // 2
+        y = (y_min + y_max) // 2 - height // 2
+        layer = self.layers[level] = (self.render_region(x, y, width, height, level), x, y)
+        return layer
+
+    def draw(self, target, x, y, tilesize):
+        """Draw the world to a surface by scaling the nearest layer,
+        where x and y are the pixel coordinates of the top left.
+
+        Returns True if an exact layer was used, or False if it was
+        scaled and should be redrawn properly later.
+        """
+        level = self.nearest(tilesize)
+        size = target.get_size()
+        x_min = x // tilesize
+        y_min = y // tilesize
+        x_max = (x + size[0] - 1) // tilesize + 1
+        y_max = (y + size[1] - 1) // tilesize + 1
+        
+        #Check the layer covers the screen
+        try:
+            layer, layer_x, layer_y = self.layers[level]
+        except KeyError:
+            layer, layer_x, layer_y = self._render_layer(level, x_min, y_min, x_max, y_max, size)
+        else:
+            layer_width, layer_height = layer.get_size()
+            if (x_min < layer_x or y_min < layer_y 
+                    or (x_max - layer_x) * level > layer_width 
+                    or (y_max - layer_y) * level > layer_height):
+                layer, layer_x, layer_y = self._render_layer(level, x_min, y_min, x_max, y_max, size)
+        
+        area = layer.subsurface(((x_min - layer_x) * level, (y_min - layer_y) * level,
+                                 (x_max - x_min) * level, (y_max - y_min) * level))
+        if level != tilesize:
+            area = pygame.transform.scale(area, ((x_max - x_min) * tilesize, (y_max - y_min) * tilesize))
+        target.blit(area, (x_min * tilesize - x, y_min * tilesize - y))
+        return level == tilesize
+
+
+class WorldRenderer(object):
+    """Keep the world drawn to a back buffer.
+
+    When the camera pans, the buffer is scrolled and only the strips
+    that came into view are drawn. Everything is redrawn if the tile
+    size or screen size changes, though zooming can be drawn from
+    pre-rendered layers until it stops.
+    """
+
+    def __init__(self, cache, render_region=None, zoom_levels=None, zoom_delay=0.2, 
+                 generator=None, prefetch_frames=30):
+        """Input the ChunkSurfaceCache to draw the sections from.
+
+        If render_region is given, full redraws will draw the whole
+        screen in one go with render_region(x, y, width, height, tilesize)
+        instead of building a cached section for every chunk.
+
+        If zoom_levels is given, changing the tile size will scale one
+        of its layers, and the exact tile size will be drawn once there
+        has been no zooming for zoom_delay seconds.
+
+        If a ChunkGenerator is given, sections will be rendered in the
+        background, and any area without its sections ready is drawn
+        with render_region instead. prefetch_frames is how far ahead
+        to look when the camera is moving.
+        """
+        self.cache = cache
+        self.render_region = render_region
+        self.zoom_levels = zoom_levels
+        self.zoom_delay = zoom_delay
+        self.generator = generator
+        self.prefetch_frames = prefetch_frames
+        self.zoom_time = 0
+        self.approximate = False
+        self.surface = None
+        self.position = None
+        self.tilesize = None
+        self.dirty_chunks = set()
+        self.dirty_rects = []
+
+    def resize(self, size, screen=None):
+        """Create a new back buffer, matching the format of the screen."""
+        if screen is None:
+            self.surface = pygame.Surface(size)
+        else:
+            self.surface = pygame.Surface(size, 0, screen)
+        self.position = None
+        if self.zoom_levels is not None:
+            self.zoom_levels.clear()
+
+    def invalidate(self, chunk_x, chunk_y):
+        """Redraw a chunk next time it is on screen."""
+        self.cache.invalidate(chunk_x, chunk_y)
+        self.dirty_chunks.add((chunk_x, chunk_y))
+        if self.zoom_levels is not None:
+            self.zoom_levels.clear()
+
+    def pending_redraw(self):
+        """If the screen was drawn from a scaled layer and zooming has
+        stopped, so it needs to be drawn again at the exact size.
+        """
+        return self.approximate and time.time() - self.zoom_time >= self.zoom_delay
+
+    def invalidate_tiles(self, coordinates):
+        """Redraw all chunks containing the tiles."""
+        self.invalidate_chunks(set((x >> CHUNK_SHIFT, y >> CHUNK_SHIFT) for x, y in coordinates))
+
+    def invalidate_chunks(self, chunks):
+        for chunk in chunks:
+            self.invalidate(*chunk)
+
+    def invalidate_rect(self, x_min, y_min, x_max, y_max):
+        """Redraw a rectangle of tiles (max values are exclusive).
+        The cached sections of every chunk it overlaps are thrown away,
+        but only the rectangle itself is redrawn on the screen.
+        """
+        if x_min >= x_max or y_min >= y_max:
+            return
+        for chunk_x in range(x_min >> CHUNK_SHIFT, ((x_max - 1) >> CHUNK_SHIFT) + 1):
+            for chunk_y in range(y_min >> CHUNK_SHIFT, ((y_max - 1) >> CHUNK_SHIFT) + 1):
+                self.cache.invalidate(chunk_x, chunk_y)
+        self.dirty_rects.append((x_min, y_min, x_max, y_max))
+        if self.zoom_levels is not None:
+            self.zoom_levels.clear()
+
+    def draw(self, x, y, tilesize):
+        """Update the back buffer, where x and y are the pixel
+        coordinates of the top left of the screen.
+
+        Returns a list of rects that changed. This is the whole buffer
+        if the camera moved or zoomed, otherwise just the areas that
+        were invalidated.
+        """
+        width, height = self.surface.get_size()
+        old_position = self.position
+        self.position = (x, y)
+
+        #Scale from a zoom level while zooming
+        zooming = old_position is not None and tilesize != self.tilesize
+        if zooming:
+            self.zoom_time = time.time()
+        if self.zoom_levels is not None and (zooming or self.approximate and not self.pending_redraw()):
+            self.tilesize = tilesize
+            self.dirty_chunks = set()
+            self.dirty_rects = []
+            self.approximate = not self.zoom_levels.draw(self.surface, x, y, tilesize)
+            return [self.surface.get_rect()]
+
+        #Full redraw
+        dx = dy = 0
+        if old_position is not None:
+            dx = x - old_position[0]
+            dy = y - old_position[1]
+        if (old_position is None or tilesize != self.tilesize or self.approximate
+                or abs(dx) >= width or abs(dy) >= height):
+            self.tilesize = tilesize
+            self.dirty_chunks = set()
+            self.dirty_rects = []
+            self.approximate = False
+            self._draw_screen()
+            return [self.surface.get_rect()]
+
+        rects = []
+
+        #Move the existing image and fill in the gaps
+        if dx or dy:
+            self.surface.scroll(-dx, -dy)
+            if dx > 0:
+                rects.append(pygame.Rect(width - dx, 0, dx, height))
+            elif dx < 0:
+                rects.append(pygame.Rect(0, 0, -dx, height))
+            if dy > 0:
+                rects.append(pygame.Rect(0, height - dy, width, dy))
+            elif dy < 0:
+                rects.append(pygame.Rect(0, 0, width, -dy))
+
+        #Redraw any chunks that changed
+        if self.dirty_chunks:
+            chunk_size = CHUNK_SIZE * tilesize
+            for chunk_x, chunk_y in self.dirty_chunks:
+                left = chunk_x * chunk_size - x
+                top = chunk_y * chunk_size - y
+                if -chunk_size < left < width and -chunk_size < top < height:
+                    rects.append(pygame.Rect(left, top, chunk_size, chunk_size).clip(0, 0, width, height))
+            self.dirty_chunks = set()
+        if self.dirty_rects:
+            for x_min, y_min, x_max, y_max in self.dirty_rects:
+                rect = pygame.Rect(x_min * tilesize - x, y_min * tilesize - y, 
+                                   (x_max - x_min) * tilesize, (y_max - y_min) * tilesize).clip(0, 0, width, height)
+                if rect:
+                    rects.append(rect)
+            self.dirty_rects = []
+
+        for rect in rects:
+            self._draw_area(rect)
+        if dx or dy:
+            return [self.surface.get_rect()]
+        return rects
+
+    def prefetch(self, x_speed, y_speed, tilesize):
+        """Request the sections the camera is moving towards, where the
+        speeds are the pixels moved in the last frame.
+        Nothing is requested while zooming.
+        """
+        if self.generator is None or self.position is None:
+            return
+        if not x_speed and not y_speed or tilesize != self.tilesize or self.approximate:
+            return
+        
+        width, height = self.surface.get_size()
+        section_size = section_span(self.tilesize) * self.tilesize
+        x_ahead = int(max(-width, min(width, x_speed * self.prefetch_frames)))
+        y_ahead = int(max(-height, min(height, y_speed * self.prefetch_frames)))
+        
+        #Build a ring around the edge of the screen in the direction of movement
+        top = min(0, y_ahead)
+        bottom = max(height, height + y_ahead)
+        left = min(0, x_ahead)
+        right = max(width, width + x_ahead)
+        areas = []
+        if x_ahead > 0:
+            areas.append(pygame.Rect(width, top, x_ahead + section_size, bottom - top))
+        elif x_ahead < 0:
+            areas.append(pygame.Rect(x_ahead - section_size, top, section_size - x_ahead, bottom - top))
+        if y_ahead > 0:
+            areas.append(pygame.Rect(left, height, right - left, y_ahead + section_size))
+        elif y_ahead < 0:
+            areas.append(pygame.Rect(left, y_ahead - section_size, right - left, section_size - y_ahead))
+        
+        keys = []
+        for rect in areas:
+            keys += [key for key, position in self._area_sections(rect)]
+        self.generator.request(keys)
+
+    def _area_sections(self, rect):
+        """Get the key and position of every section overlapping an
+        area of the buffer.
+        """
+        x, y = self.position
+        tilesize = self.tilesize
+        span = section_span(tilesize)
+        section_size = span * tilesize
+        
+        sections = []
+        for section_x in range((x + rect.left) // section_size, (x + rect.right - 1) // section_size + 1):
+            for section_y in range((y + rect.top) // section_size, (y + rect.bottom - 1) // section_size + 1):
+                key = ((section_x * span) >> CHUNK_SHIFT, (section_y * span) >> CHUNK_SHIFT, 
+                       section_x, section_y, tilesize)
+                sections.append((key, (section_x * section_size - x, section_y * section_size - y)))
+        return sections
+
+    def _draw_screen(self):
+        """Draw the whole buffer."""
+        if self.render_region is None:
+            self._draw_area(self.surface.get_rect())
+        else:
+            self._draw_region(self.surface.get_rect())
+
+    def _draw_region(self, rect):
+        """Draw an area of the buffer directly with render_region."""
+        x, y = self.position
+        tilesize = self.tilesize
+        x_min = (x + rect.left) // tilesize
+        y_min = (y + rect.top) // tilesize
+        x_max = (x + rect.right - 1) // tilesize + 1
+        y_max = (y + rect.bottom - 1) // tilesize + 1
+        surface = self.render_region(x_min, y_min, x_max - x_min, y_max - y_min, tilesize)
+        
+        self.surface.set_clip(rect)
+        self.surface.blit(surface, (x_min * tilesize - x, y_min * tilesize - y))
+        self.surface.set_clip(None)
+
+    def _draw_area(self, rect):
+        """Blit every section overlapping an area of the buffer."""
+        sections = self._area_sections(rect)
+        
+        #Don't wait for the generator if the sections aren't ready
+        if self.generator is not None and self.render_region is not None:
+            if not all(key in self.cache for key, position in sections):
+                self._draw_region(rect)
+                return
+        
+        self.surface.set_clip(rect)
+        for key, position in sections:
+            self.surface.blit(self.cache.get(*key), position)
+        self.surface.set_clip(None)
@@ -0,0 +1,180 @@
+import struct
+import time
+
+import pygame
+
+try:
+    from time import perf_counter
+except ImportError:
+    from time import time as perf_counter
+
+MAGIC = b'DKRP'
+VERSION = 1
+HEADER = struct.Struct('<4sHHHHHq')
+FRAME = struct.Struct('<HHffhhBB')
+
+#Event types that get recorded, and the data stored with each
+_CODE = struct.Struct('<B')
+_KEY = struct.Struct('<i')
+_BUTTON = struct.Struct('<Bhh')
+_SIZE = struct.Struct('<HH')
+_EVENTS = [
+    (pygame.QUIT, None, ()),
+    (pygame.KEYDOWN, _KEY, ('key',)),
+    (pygame.KEYUP, _KEY, ('key',)),
+    (pygame.MOUSEBUTTONDOWN, _BUTTON, ('button', 'pos')),
+    (pygame.MOUSEBUTTONUP, _BUTTON, ('button', 'pos')),
+    (pygame.VIDEORESIZE, _SIZE, ('size',)),
+]
+_EVENT_CODES = {event_type: code for code, (event_type, data, attributes) in enumerate(_EVENTS)}
+
+
+class ScriptedKeys(object):
+    """Stand in for pygame.key.get_pressed()."""
+
+    def __init__(self, pressed=()):
+        self.pressed = set(pressed)
+
+    def __getitem__(self, key):
+        return key in self.pressed
+
+
+def _ushort(value):
+    """Clamp a count such as ticks or fps into an unsigned short, so
+    an odd value can't stop the game by failing to pack.
+    """
+    return max(0, min(int(value or 0), 0xFFFF))
+
+
+def _pack_event(event):
+    """Get the bytes of an event, or None if it isn't recorded."""
+    try:
+        code = _EVENT_CODES[event.type]
+    except KeyError:
+        return None
+    data = _EVENTS[code][1]
+    if data is None:
+        return _CODE.pack(code)
+    if data is _KEY:
+        values = (event.key,)
+    elif data is _BUTTON:
+        values = (event.button,) + tuple(event.pos)
+    else:
+        values = tuple(event.size)
+    return _CODE.pack(code) + data.pack(*values)
+
+
+class InputRecorder(object):
+    """Write the input of every frame to a file, so the session can be
+    played back with InputReplay.
+
+    The file starts with a header, followed by a record per frame:
+
+        header  magic, version, ticks per second, frames per second
+                (0 if not limited), screen width and height, world seed
+        frame   ticks run, fps (0 if not updated), alpha, seconds since
+                the last frame, mouse x and y, mouse buttons as bits,
+                number of events
+        events  event code followed by its data
+
+    Only the events the game reacts to are kept, and the held keys are
+    worked out from the key events when played back.
+    """
+
+    def __init__(self, path, ticks, fps, size, seed=0):
+        self.file = open(path, 'wb')
+        self.file.write(HEADER.pack(MAGIC, VERSION, _ushort(ticks), _ushort(fps), size[0], size[1], seed))
+        self.last_time = perf_counter()
+
+    def write(self, frame_data, ticks, fps=None, alpha=None):
+        """Record the input of a frame, as passed to MainGame.frame."""
+        now = perf_counter()
+        events = [event for event in map(_pack_event, frame_data['Events']) if event is not None]
+        buttons = 0
+        for i, pressed in enumerate(frame_data['MouseClick']):
+            if pressed:
+                buttons |= 1 << i
+        mouse_x, mouse_y = frame_data['MousePos']
+        self.file.write(FRAME.pack(_ushort(ticks), _ushort(fps), 1.0 if alpha is None else alpha, now - self.last_time,
+                                   mouse_x, mouse_y, buttons, len(events)))
+        self.file.write(b''.join(events))
+        self.last_time = now
+
+    def close(self):
+        self.file.close()
+
+
+class InputReplay(object):
+    """Read a file written by InputRecorder.
+
+    Replays start from a new game, so the world must be the same as
+    when it was recorded, such as the same seed and no WORLD_FILE.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.data = f.read()
+        magic, version, self.ticks, self.fps, width, height, self.seed = HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC:
+            raise ValueError('{} is not a replay file'.format(path))
+        if version != VERSION:
+            raise ValueError('unsupported replay file version {}'.format(version))
+        self.size = (width, height)
+
+    def configure(self, game):
+        """Set up a MainGame to match the recording, before calling setup."""
+        game.TICKS = self.ticks
+        game.FPS = self.fps or None
+        game.WIDTH, game.HEIGHT = self.size
+        game.WORLD_SEED = self.seed
+        game.WORLD_FILE = None
+
+    def __iter__(self):
+        """Iterate over the frames.
+        Yields (frame_data, ticks, fps, alpha, frame_time).
+        """
+        keys = set()
+        offset = HEADER.size
+        while offset < len(self.data):
+            ticks, fps, alpha, frame_time, mouse_x, mouse_y, buttons, count = FRAME.unpack_from(self.data, offset)
+            offset += FRAME.size
+
+            events = []
+            for i in range(count):
+                event_type, data, attributes = _EVENTS[_CODE.unpack_from(self.data, offset)[0]]
+                offset += _CODE.size
+                values = ()
+                if data is not None:
+                    values = data.unpack_from(self.data, offset)
+                    offset += data.size
+                if data is _BUTTON:
+                    values = (values[0], values[1:])
+                elif data is _SIZE:
+                    values = (values,)
+                event = pygame.event.Event(event_type, dict(zip(attributes, values)))
+                if event_type == pygame.KEYDOWN:
+                    keys.add(event.key)
+                elif event_type == pygame.KEYUP:
+                    keys.discard(event.key)
+                events.append(event)
+
+            frame_data = {'Redraw': False,
+                          'Events': events,
+                          'Keys': ScriptedKeys(keys),
+                          'MousePos': (mouse_x, mouse_y),
+                          'MouseClick': tuple(bool(buttons & 1 << i) for i in range(3))}
+            yield frame_data, ticks, fps or None, alpha, frame_time
+
+    def frames(self, realtime=False):
+        """Iterate over the frames as (frame_data, ticks, fps, alpha).
+        If realtime is set, this waits between frames to match the
+        recorded speed, otherwise they are given as fast as possible.
+        """
+        next_time = perf_counter()
+        for frame_data, ticks, fps, alpha, frame_time in self:
+            if realtime:
+                next_time += frame_time
+                delay = next_time - perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            yield frame_data, ticks, fps, alpha
@@ -0,0 +1,182 @@
+import mmap
+import os
+import struct
+from array import array
+
+from DKWorld import CHUNK_SHIFT, CHUNK_SIZE, TILEMAP, TileChunk, WorldGenerator
+
+MAGIC = b'DKWD'
+VERSION = 2
+HEADER = struct.Struct('<4sHBBqQQ')
+HEADER_START = struct.Struct('<4sH')
+INDEX_ENTRY = struct.Struct('<qqQ')
+RECORD_SIZE = CHUNK_SIZE * CHUNK_SIZE
+
+
+class WorldFile(object):
+    """Chunk storage for a TileMap, backed by a memory mapped file.
+
+    The file starts with a header, followed by fixed size chunk records,
+    with the chunk index at the end:
+
+        header  magic, version, chunk shift, default tile, seed of
+                the generator, number of chunks, offset of the index
+        records CHUNK_SIZE * CHUNK_SIZE tile ids per chunk
+        index   (chunk x, chunk y, record offset) per chunk
+
+    Only the chunks that get used are read from disk, and saving only
+    writes the chunks that were edited. Any chunks not in the file are
+    made by a WorldGenerator with the saved seed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'r+b')
+        self.mmap = None
+        self._read_index()
+
+    def __contains__(self, chunk):
+        return chunk in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def _read_index(self):
+        if self.mmap is not None:
+            self.mmap.close()
+        self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version = HEADER_START.unpack_from(self.mmap, 0)
+        if magic != MAGIC:
+            raise ValueError('{} is not a world file'.format(self.path))
+        if version != VERSION:
+            raise ValueError('unsupported world file version {}'.format(version))
+        magic, version, chunk_shift, self.default, self.seed, count, self.index_offset = HEADER.unpack_from(self.mmap, 0)
+        if chunk_shift != CHUNK_SHIFT:
+            raise ValueError('world file uses chunks of size {}'.format(1 << chunk_shift))
+
+        self.index = {}
+        for i in range(count):
+            x, y, offset = INDEX_ENTRY.unpack_from(self.mmap, self.index_offset + i * INDEX_ENTRY.size)
+            self.index[(x, y)] = offset
+
+    def load_chunk(self, x, y):
+        """Read a chunk from the file, or return None if it isn't saved."""
+        try:
+            offset = self.index[(x, y)]
+        except KeyError:
+            return None
+        return TileChunk(x, y, tiles=array('B', self.mmap[offset:offset + RECORD_SIZE]))
+
+    def read_record(self, x, y):
+        """Get the raw tiles of a saved chunk without loading it."""
+        offset = self.index[(x, y)]
+        return self.mmap[offset:offset + RECORD_SIZE]
+
+    def save(self, tilemap):
+        """Write any edited chunks back to the file.
+        New chunks are added after the existing records, and the index
+        is moved to the end.
+        """
+        new_chunks = []
+        for key in tilemap.dirty:
+            chunk = tilemap.chunks.get(key)
+            if chunk is None:
+                continue
+            if key in self.index:
+                self.file.seek(self.index[key])
+                self.file.write(chunk.tiles)
+            else:
+                new_chunks.append((key, chunk.tiles))
+
+        self.append(new_chunks)
+        tilemap.dirty = set()
+
+    def append(self, records):
+        """Add new chunks after the existing records, and move the
+        index to the end.
+        Takes an iterable of ((chunk x, chunk y), tiles), where the
+        tiles are bytes or an array.
+        """
+        offset = self.index_offset
+        self.file.seek(offset)
+        for key, tiles in records:
+            self.file.write(tiles)
+            self.index[key] = offset
+            offset += RECORD_SIZE
+
+        if offset != self.index_offset:
+            self.index_offset = offset
+            self._write_index()
+            self.file.flush()
+            self._read_index()
+        else:
+            self.file.flush()
+
+    def _write_index(self):
+        self.file.seek(0)
+        self.file.write(HEADER.pack(MAGIC, VERSION, CHUNK_SHIFT, self.default, self.seed,
+                                    len(self.index), self.index_offset))
+        self.file.seek(self.index_offset)
+        self.file.write(b''.join(INDEX_ENTRY.pack(x, y, offset)
+                                 for (x, y), offset in self.index.items()))
+        self.file.truncate()
+
+    def close(self):
+        self.mmap.close()
+        self.file.close()
+
+
+def _world_records(tilemap):
+    """Get the tiles of every chunk in a TileMap.
+    Chunks that are saved in the source but not in memory, such as
+    ones forgotten by the cache, are copied straight from the source.
+    """
+    chunks = dict(tilemap.chunks)
+    for key, chunk in chunks.items():
+        yield key, chunk.tiles
+    source = tilemap.source
+    if source is not None:
+        for key in list(source.index):
+            if key not in chunks:
+                yield key, source.read_record(*key)
+
+
+def create_world(path, tilemap=TILEMAP):
+    """Write every chunk of a TileMap to a new file, along with the
+    seed of its generator.
+    """
+    seed = getattr(tilemap.generator, 'seed', 0)
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, CHUNK_SHIFT, tilemap.default, seed, 0, HEADER.size))
+    world_file = WorldFile(path)
+    world_file.append(_world_records(tilemap))
+    tilemap.dirty = set()
+    return world_file
+
+
+def save_world(path, tilemap=TILEMAP):
+    """Save a TileMap, only writing the edited chunks if it was loaded
+    from the same file.
+    The TileMap is locked while saving, as the mmap is replaced when
+    chunks are added, and the render thread may be reading from it.
+    """
+    with tilemap.lock:
+        source = tilemap.source
+        if source is not None and os.path.abspath(source.path) == os.path.abspath(path):
+            source.save(tilemap)
+        else:
+            tilemap.source = create_world(path, tilemap)
+
+
+def load_world(path, tilemap=TILEMAP):
+    """Open a world file, replacing all the chunks in a TileMap.
+    The chunks will be read when they are first used, and if the
+    TileMap has a generator, it is replaced with one using the seed
+    the world was made with.
+    """
+    world_file = WorldFile(path)
+    tilemap.load(world_file)
+    if tilemap.generator is not None:
+        tilemap.generator = WorldGenerator(world_file.seed)
+    return world_file
@@ -0,0 +1,191 @@
+from binascii import unhexlify
+
+import numpy
+
+from DKWorld import CHUNK_SHIFT, CHUNK_SIZE, CHUNK_MASK
+
+_CHUNK_TILES = CHUNK_SIZE * CHUNK_SIZE
+_CHUNK_BYTES = _CHUNK_TILES // 8
+
+#Multiplying a column mask by this repeats it for every column
+_COLUMN_REPEAT = ((1 << _CHUNK_TILES) - 1) // ((1 << CHUNK_SIZE) - 1)
+
+
+def rect_difference(a, b):
+    """Get the parts of rect a that aren't in rect b.
+    Rects are (x_min, y_min, x_max, y_max) with exclusive max values,
+    and up to 4 rects will be returned.
+    """
+    x1, y1, x2, y2 = a
+    bx1, by1, bx2, by2 = b
+    if bx1 >= x2 or bx2 <= x1 or by1 >= y2 or by2 <= y1:
+        return [a]
+
+    rects = []
+    if by1 > y1:
+        rects.append((x1, y1, x2, by1))
+    if by2 < y2:
+        rects.append((x1, by2, x2, y2))
+    y1 = max(y1, by1)
+    y2 = min(y2, by2)
+    if bx1 > x1:
+        rects.append((x1, y1, bx1, y2))
+    if bx2 < x2:
+        rects.append((bx2, y1, x2, y2))
+    return rects
+
+
+def _rect_mask(x1, y1, x2, y2):
+    """Build a chunk bitmask from local coordinates (max is exclusive)."""
+    column = ((1 << (y2 - y1)) - 1) << y1
+    return (column * (_COLUMN_REPEAT >> (CHUNK_SIZE * (CHUNK_SIZE - x2 + x1)))) << (CHUNK_SIZE * x1)
+
+
+def mask_array(mask):
+    """Convert a chunk bitmask to a numpy bool array indexed by [x, y]."""
+    #Big endian bytes unpack with the highest bit first, so reverse them
+    data = unhexlify('{:0{}x}'.format(mask, _CHUNK_BYTES * 2))
+    bits = numpy.unpackbits(numpy.frombuffer(data, dtype=numpy.uint8))[::-1]
+    return bits.reshape(CHUNK_SIZE, CHUNK_SIZE).astype(bool)
+
+
+class TileSelection(object):
+    """Set of tiles, stored as an integer bitmask for each chunk.
+
+    The bits use the same layout as TileChunk, so bit n is the tile
+    at local x * CHUNK_SIZE + local y. Rectangles can be added or
+    removed with a few operations per chunk instead of per tile.
+    """
+
+    def __init__(self):
+        self.masks = {}
+
+    def __repr__(self):
+        return 'TileSelection({} tiles in {} chunks)'.format(len(self), len(self.masks))
+
+    def __contains__(self, coordinate):
+        x, y = coordinate
+        mask = self.masks.get((x >> CHUNK_SHIFT, y >> CHUNK_SHIFT), 0)
+        return bool(mask >> ((x & CHUNK_MASK) << CHUNK_SHIFT | (y & CHUNK_MASK)) & 1)
+
+    def __len__(self):
+        return sum(bin(mask).count('1') for mask in self.masks.values())
+
+    def __bool__(self):
+        return bool(self.masks)
+    __nonzero__ = __bool__
+
+    def __iter__(self):
+        for (chunk_x, chunk_y), mask in self.masks.items():
+            origin_x = chunk_x << CHUNK_SHIFT
+            origin_y = chunk_y << CHUNK_SHIFT
+            i = 0
+            while mask:
+                if mask & 1:
+                    yield (origin_x + (i >> CHUNK_SHIFT), origin_y + (i & CHUNK_MASK))
+                mask >>= 1
+                i += 1
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def __isub__(self, other):
+        self.difference_update(other)
+        return self
+
+    def copy(self):
+        selection = TileSelection()
+        selection.masks = dict(self.masks)
+        return selection
+
+    def clear(self):
+        self.masks = {}
+
+    def chunks(self):
+        """Get the coordinates of every chunk with a selected tile."""
+        return list(self.masks)
+
+    def add(self, coordinate):
+        x, y = coordinate
+        chunk = (x >> CHUNK_SHIFT, y >> CHUNK_SHIFT)
+        self.masks[chunk] = self.masks.get(chunk, 0) | 1 << ((x & CHUNK_MASK) << CHUNK_SHIFT | (y & CHUNK_MASK))
+
+    def discard(self, coordinate):
+        x, y = coordinate
+        chunk = (x >> CHUNK_SHIFT, y >> CHUNK_SHIFT)
+        mask = self.masks.get(chunk, 0) & ~(1 << ((x & CHUNK_MASK) << CHUNK_SHIFT | (y & CHUNK_MASK)))
+        self._set_mask(chunk, mask)
+
+    def _set_mask(self, chunk, mask):
+        if mask:
+            self.masks[chunk] = mask
+        else:
+            self.masks.pop(chunk, None)
+
+    def _rect_chunks(self, x_min, y_min, x_max, y_max):
+        """Get each chunk in a rect along with its local rect mask."""
+        for chunk_x in range(x_min >> CHUNK_SHIFT, ((x_max - 1) >> CHUNK_SHIFT) + 1):
+            origin_x = chunk_x << CHUNK_SHIFT
+            x1 = max(x_min, origin_x) - origin_x
+            x2 = min(x_max, origin_x + CHUNK_SIZE) - origin_x
+            for chunk_y in range(y_min >> CHUNK_SHIFT, ((y_max - 1) >> CHUNK_SHIFT) + 1):
+                origin_y = chunk_y << CHUNK_SHIFT
+                y1 = max(y_min, origin_y) - origin_y
+                y2 = min(y_max, origin_y + CHUNK_SIZE) - origin_y
+                yield (chunk_x, chunk_y), _rect_mask(x1, y1, x2, y2)
+
+    def add_rect(self, x_min, y_min, x_max, y_max):
+        """Select a rectangle of tiles (max values are exclusive)."""
+        if x_min >= x_max or y_min >= y_max:
+            return
+        masks = self.masks
+        for chunk, mask in self._rect_chunks(x_min, y_min, x_max, y_max):
+            masks[chunk] = masks.get(chunk, 0) | mask
+
+    def remove_rect(self, x_min, y_min, x_max, y_max):
+        """Deselect a rectangle of tiles (max values are exclusive)."""
+        if x_min >= x_max or y_min >= y_max:
+            return
+        masks = self.masks
+        for chunk, mask in self._rect_chunks(x_min, y_min, x_max, y_max):
+            if chunk in masks:
+                self._set_mask(chunk, masks[chunk] & ~mask)
+
+    def update(self, other):
+        """Add all tiles from another selection."""
+        masks = self.masks
+        for chunk, mask in other.masks.items():
+            masks[chunk] = masks.get(chunk, 0) | mask
+
+    def difference_update(self, other):
+        """Remove all tiles that are in another selection."""
+        masks = self.masks
+        for chunk, mask in other.masks.items():
+            if chunk in masks:
+                self._set_mask(chunk, masks[chunk] & ~mask)
+
+    def chunk_array(self, chunk_x, chunk_y):
+        """Get a chunk as a numpy bool array indexed by [x, y]."""
+        return mask_array(self.masks.get((chunk_x, chunk_y), 0))
+
+    def region_array(self, x, y, width, height):
+        """Get which tiles are selected in a rectangle, as a numpy bool
+        array indexed by [x, y] relative to the top left corner.
+        """
+        region = numpy.zeros((width, height), dtype=bool)
+        x_max = x + width
+        y_max = y + height
+        for chunk_x in range(x >> CHUNK_SHIFT, ((x_max - 1) >> CHUNK_SHIFT) + 1):
+            for chunk_y in range(y >> CHUNK_SHIFT, ((y_max - 1) >> CHUNK_SHIFT) + 1):
+                if (chunk_x, chunk_y) not in self.masks:
+                    continue
+                origin_x = chunk_x << CHUNK_SHIFT
+                origin_y = chunk_y << CHUNK_SHIFT
+                x1 = max(x, origin_x)
+                y1 = max(y, origin_y)
+                x2 = min(x_max, origin_x + CHUNK_SIZE)
+                y2 = min(y_max, origin_y + CHUNK_SIZE)
+                region[x1 - x:x2 - x, y1 - y:y2 - y] = self.chunk_array(chunk_x, chunk_y)[x1 - origin_x:x2 - origin_x,
+                                                                                          y1 - origin_y:y2 - origin_y]
+        return region
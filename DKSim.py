@@ -0,0 +1,265 @@
+from __future__ import division
+import multiprocessing
+import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+import numpy
+
+from FrameLimit import GameTime, GameTimeLoop
+
+#Columns of the entity snapshot
+SNAPSHOT_COLUMNS = ('id', 'kind', 'x', 'y')
+
+#Tiles moved per tick
+UNIT_SPEED = 0.05
+
+
+class Simulation(object):
+    """Game logic that runs once per tick, with the entities stored in
+    numpy arrays so they can all be updated at once.
+
+    Commands such as spawn are sent with command(name, *args), and the
+    state is read with latest(), so it can be swapped for a
+    SimulationProcess without changing the code using it.
+    """
+
+    def __init__(self, max_entities=4096):
+        self.max_entities = max_entities
+        self.count = 0
+        self.ticks = 0
+        self.next_id = 0
+        self.indexes = {}
+        self.ids = numpy.zeros(max_entities, dtype=numpy.int64)
+        self.kinds = numpy.zeros(max_entities, dtype=numpy.int64)
+        self.position = numpy.zeros((max_entities, 2))
+        self.target = numpy.zeros((max_entities, 2))
+        self.changed = True
+
+    def command(self, name, *args):
+        """Run a command, which is the name of a method and its arguments.
+        Commands that can't be done, such as spawning when full, are
+        ignored, since there is nothing to send the error back to when
+        running in a SimulationProcess.
+        """
+        try:
+            getattr(self, 'cmd_' + name)(*args)
+        except ValueError:
+            pass
+
+    def cmd_spawn(self, kind, x, y):
+        """Add an entity that stays where it is until moved."""
+        if self.count >= self.max_entities:
+            raise ValueError('too many entities')
+        i = self.count
+        self.ids[i] = self.next_id
+        self.kinds[i] = kind
+        self.position[i] = self.target[i] = (x, y)
+        self.indexes[self.next_id] = i
+        self.next_id += 1
+        self.count += 1
+        self.changed = True
+
+    def cmd_remove(self, entity_id):
+        """Remove an entity, moving the last one into its place."""
+        i = self.indexes.pop(entity_id, None)
+        if i is None:
+            return
+        last = self.count - 1
+        if i != last:
+            for data in (self.ids, self.kinds, self.position, self.target):
+                data[i] = data[last]
+            self.indexes[int(self.ids[i])] = i
+        self.count -= 1
+        self.changed = True
+
+    def cmd_move_to(self, x, y, entity_ids=None):
+        """Set where entities should walk to, or all of them if no
+        ids are given.
+        """
+        if entity_ids is None:
+            self.target[:self.count] = (x, y)
+        else:
+            for entity_id in entity_ids:
+                i = self.indexes.get(entity_id)
+                if i is not None:
+                    self.target[i] = (x, y)
+
+    def tick(self):
+        """Move every entity towards its target."""
+        self.ticks += 1
+        position = self.position[:self.count]
+        offset = self.target[:self.count] - position
+        distance = numpy.hypot(offset[:, 0], offset[:, 1])
+        moving = distance > 0
+        if not moving.any():
+            return
+        step = numpy.minimum(distance[moving], UNIT_SPEED) / distance[moving]
+        position[moving] += offset[moving] * step[:, None]
+        self.changed = True
+
+    def moving(self):
+        """If any entity hasn't reached its target."""
+        return bool((self.position[:self.count] != self.target[:self.count]).any())
+
+    def update(self, ticks):
+        """Run a number of ticks."""
+        for i in range(ticks):
+            self.tick()
+
+    def snapshot(self):
+        """Get the entities as an array with a row per entity."""
+        return numpy.column_stack((self.ids[:self.count], self.kinds[:self.count],
+                                   self.position[:self.count])).astype(numpy.float64)
+
+    def latest(self):
+        """Get (tick, snapshot) if anything changed since the last call,
+        otherwise None.
+        """
+        if not self.changed:
+            return None
+        self.changed = False
+        return self.ticks, self.snapshot()
+
+
+class SnapshotBuffer(object):
+    """Two entity snapshots in shared memory, so one process can write
+    a new snapshot while another reads the last one.
+
+    The header is the index of the latest buffer, followed by the
+    sequence number, tick and entity count of each buffer. The sequence
+    number is odd while a buffer is being written, so a reader can tell
+    if what it copied was torn and try again.
+    """
+    HEADER_SIZE = 7
+
+    def __init__(self, memory, max_entities):
+        """Input the shared memory block and the entity capacity."""
+        self.memory = memory
+        self.max_entities = max_entities
+        self.header = numpy.ndarray((self.HEADER_SIZE,), dtype=numpy.int64, buffer=memory.buf)
+        self.data = numpy.ndarray((2, max_entities, len(SNAPSHOT_COLUMNS)), dtype=numpy.float64,
+                                  buffer=memory.buf, offset=self.header.nbytes)
+        self.last_read = None
+
+    @classmethod
+    def size(cls, max_entities):
+        """Get the number of bytes needed."""
+        return 8 * cls.HEADER_SIZE + 8 * 2 * max_entities * len(SNAPSHOT_COLUMNS)
+
+    def write(self, tick, snapshot):
+        """Write to the buffer that isn't the latest, then make it the latest."""
+        index = 1 - self.header[0]
+        sequence = 1 + index * 3
+        self.header[sequence] += 1
+        self.data[index, :len(snapshot)] = snapshot
+        self.header[sequence + 1] = tick
+        self.header[sequence + 2] = len(snapshot)
+        self.header[sequence] += 1
+        self.header[0] = index
+
+    def read(self):
+        """Copy the latest snapshot.
+        Returns (tick, snapshot), or None if it was already read.
+        """
+        while True:
+            index = self.header[0]
+            sequence = 1 + index * 3
+            before = self.header[sequence]
+            if (index, before) == self.last_read:
+                return None
+            if before & 1:
+                continue
+            tick = int(self.header[sequence + 1])
+            snapshot = self.data[index, :self.header[sequence + 2]].copy()
+            if self.header[sequence] == before:
+                self.last_read = (index, before)
+                return tick, snapshot
+
+
+def _run(name, max_entities, ticks, commands):
+    """Run a Simulation until told to stop, from the worker process."""
+    memory = shared_memory.SharedMemory(name)
+    snapshots = SnapshotBuffer(memory, max_entities)
+    simulation = Simulation(max_entities)
+    game_time = GameTime(ticks, ticks)
+    try:
+        while True:
+            with GameTimeLoop(game_time) as loop:
+                while True:
+                    try:
+                        command = commands.get_nowait()
+                    except queue.Empty:
+                        break
+                    if command is None:
+                        return
+                    simulation.command(*command)
+                simulation.update(loop.ticks)
+                latest = simulation.latest()
+                if latest is not None:
+                    snapshots.write(*latest)
+    finally:
+        del snapshots
+        memory.close()
+
+
+class SimulationProcess(object):
+    """Run a Simulation in another process, so the ticks use a
+    different core to the drawing.
+
+    Commands are sent through a queue, and the entities come back
+    through a SnapshotBuffer, so the main process never waits for the
+    simulation. The worker keeps its own fixed tick rate.
+
+    The process is spawned instead of forked, since the game already
+    has the chunk render thread running, and forking a process with
+    threads can deadlock the child.
+    """
+
+    def __init__(self, max_entities=4096, ticks=120):
+        if shared_memory is None:
+            raise RuntimeError('running the simulation in a process requires Python 3.8+')
+        self.max_entities = max_entities
+        self.memory = shared_memory.SharedMemory(create=True, size=SnapshotBuffer.size(max_entities))
+        self.snapshots = SnapshotBuffer(self.memory, max_entities)
+        self.snapshots.header[:] = 0
+        context = multiprocessing.get_context('spawn')
+        self.commands = context.Queue()
+        self.process = context.Process(target=_run, args=(self.memory.name, max_entities,
+                                                          ticks, self.commands))
+        self.process.daemon = True
+        self.process.start()
+        self.snapshot_time = 0
+
+    def command(self, name, *args):
+        self.commands.put((name,) + args)
+
+    def update(self, ticks):
+        """The worker runs its own ticks, so this does nothing."""
+        pass
+
+    def moving(self, timeout=0.1):
+        """If a new snapshot has arrived recently."""
+        return time.time() - self.snapshot_time < timeout
+
+    def latest(self):
+        """Get (tick, snapshot) if there's a new one, otherwise None."""
+        latest = self.snapshots.read()
+        if latest is not None:
+            self.snapshot_time = time.time()
+        return latest
+
+    def stop(self):
+        self.commands.put(None)
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.terminate()
+        del self.snapshots
+        self.memory.close()
+        self.memory.unlink()
@@ -0,0 +1,168 @@
+import numpy
+
+from DKWorld import CHUNK_SHIFT, CHUNK_SIZE, GRASS, TILEMAP, WATER
+
+#Tiles that water can flow into
+FLOODABLE = (GRASS,)
+
+
+class WaterSimulation(object):
+    """Water spreading into open tiles, one tile every flow_ticks ticks.
+
+    Only water next to a change is unsettled, and it floods any open
+    tiles next to it, which then become unsettled themselves. This is
+    stored as a uint8 array for each active chunk, and a chunk goes back
+    to sleep as soon as a step finds nothing to flood, so settled water
+    costs nothing no matter how much of it there is.
+
+    The value is how many more tiles the water can flow. A change gives
+    the water next to it spread tiles, and every flooded tile gets one
+    less than the water it came from, so an edit on the shore only
+    floods the tiles near it instead of the whole island.
+    """
+
+    def __init__(self, tilemap=TILEMAP, flow_ticks=8, floodable=FLOODABLE, spread=4):
+        self.tilemap = tilemap
+        self.flow_ticks = flow_ticks
+        self.spread = spread
+        self.floodable = numpy.array(sorted(floodable), dtype=numpy.uint8)
+        self.unsettled = {}
+        self.ticks = 0
+
+    def __bool__(self):
+        return bool(self.unsettled)
+    __nonzero__ = __bool__
+
+    @property
+    def active(self):
+        """Get the chunks that will be updated."""
+        return set(self.unsettled)
+
+    def _chunk(self, chunk):
+        try:
+            return self.unsettled[chunk]
+        except KeyError:
+            unsettled = self.unsettled[chunk] = numpy.zeros((CHUNK_SIZE, CHUNK_SIZE), dtype=numpy.uint8)
+            return unsettled
+
+    def disturb_rect(self, x_min, y_min, x_max, y_max):
+        """Unsettle the water in and next to a rectangle of tiles that
+        changed (max values are exclusive).
+        """
+        if x_min >= x_max or y_min >= y_max:
+            return
+        x_min -= 1
+        y_min -= 1
+        x_max += 1
+        y_max += 1
+        for chunk_x in range(x_min >> CHUNK_SHIFT, ((x_max - 1) >> CHUNK_SHIFT) + 1):
+            origin_x = chunk_x << CHUNK_SHIFT
+            x1 = max(x_min, origin_x) - origin_x
+            x2 = min(x_max, origin_x + CHUNK_SIZE) - origin_x
+            for chunk_y in range(y_min >> CHUNK_SHIFT, ((y_max - 1) >> CHUNK_SHIFT) + 1):
+                origin_y = chunk_y << CHUNK_SHIFT
+                y1 = max(y_min, origin_y) - origin_y
+                y2 = min(y_max, origin_y + CHUNK_SIZE) - origin_y
+                unsettled = self._chunk((chunk_x, chunk_y))[x1:x2, y1:y2]
+                numpy.maximum(unsettled, self.spread, out=unsettled)
+
+    def _unsettled_region(self, chunk_x, chunk_y):
+        """Get the unsettled tiles of a chunk plus 1 tile around it."""
+        region = numpy.zeros((CHUNK_SIZE + 2, CHUNK_SIZE + 2), dtype=numpy.uint8)
+        get = self.unsettled.get
+        region[1:-1, 1:-1] = get((chunk_x, chunk_y))
+        for edge, neighbour, side in (((0, slice(1, -1)), (chunk_x - 1, chunk_y), (-1, slice(None))),
+                                      ((-1, slice(1, -1)), (chunk_x + 1, chunk_y), (0, slice(None))),
+                                      ((slice(1, -1), 0), (chunk_x, chunk_y - 1), (slice(None), -1)),
+                                      ((slice(1, -1), -1), (chunk_x, chunk_y + 1), (slice(None), 0))):
+            unsettled = get(neighbour)
+            if unsettled is not None:
+                region[edge] = unsettled[side]
+        return region
+
+    def _flow(self, chunk_x, chunk_y):
+        """Find which tiles of a chunk get flooded this step.
+        Returns a numpy bool array of the flooded tiles, and a uint8
+        array of how much further the water can flow from them, both
+        indexed by [x, y].
+        """
+        tiles = self.tilemap.get_tile_region((chunk_x << CHUNK_SHIFT) - 1, (chunk_y << CHUNK_SHIFT) - 1,
+                                             CHUNK_SIZE + 2, CHUNK_SIZE + 2)
+        water = numpy.where(tiles == WATER, self._unsettled_region(chunk_x, chunk_y), 0).astype(numpy.uint8)
+        next_to_water = numpy.maximum(numpy.maximum(water[:-2, 1:-1], water[2:, 1:-1]),
+                                      numpy.maximum(water[1:-1, :-2], water[1:-1, 2:]))
+        flow = (next_to_water > 0) & numpy.isin(tiles[1:-1, 1:-1], self.floodable)
+        return flow, numpy.where(flow, next_to_water - 1, 0).astype(numpy.uint8)
+
+    def step(self):
+        """Flood every open tile next to unsettled water that can
+        still flow.
+        Returns the rects of tiles that changed.
+        """
+        flows = [(chunk, self._flow(*chunk)) for chunk in self.unsettled]
+        self.unsettled = {}
+        changed = []
+        water = numpy.full((CHUNK_SIZE, CHUNK_SIZE), WATER, dtype=numpy.uint8)
+        for (chunk_x, chunk_y), (flow, levels) in flows:
+            if not flow.any():
+                continue
+            origin_x = chunk_x << CHUNK_SHIFT
+            origin_y = chunk_y << CHUNK_SHIFT
+            self.tilemap.set_tile_region(origin_x, origin_y, water, flow)
+
+            #Water that can't flow any further is settled straight away
+            if levels.any():
+                unsettled = self._chunk((chunk_x, chunk_y))
+                numpy.maximum(unsettled, levels, out=unsettled)
+
+                #Wake up the neighbours if it reached the edge
+                if levels[0].any():
+                    self._chunk((chunk_x - 1, chunk_y))
+                if levels[-1].any():
+                    self._chunk((chunk_x + 1, chunk_y))
+                if levels[:, 0].any():
+                    self._chunk((chunk_x, chunk_y - 1))
+                if levels[:, -1].any():
+                    self._chunk((chunk_x, chunk_y + 1))
+
+            columns = numpy.nonzero(flow.any(axis=1))[0]
+            rows = numpy.nonzero(flow.any(axis=0))[0]
+            changed.append((origin_x + int(columns[0]), origin_y + int(rows[0]),
+                            origin_x + int(columns[-1]) + 1, origin_y + int(rows[-1]) + 1))
+        return changed
+
+    def update(self, ticks):
+        """Run a number of ticks.
+        Returns the rects of tiles that changed.
+        """
+        changed = []
+        for i in range(ticks):
+            self.ticks += 1
+            if self.unsettled and not self.ticks % self.flow_ticks:
+                changed += self.step()
+        return changed
+
+
+if __name__ == '__main__':
+    #Check that an edit on the shore of the start island only floods
+    #the tiles near it, instead of the whole island
+    from DKWorld import WorldGenerator, TileMap
+    tilemap = TileMap(generator=WorldGenerator(0))
+    water = WaterSimulation(tilemap)
+    
+    def count_grass():
+        return int((tilemap.get_tile_region(-64, -64, 128, 128) == GRASS).sum())
+    grass = count_grass()
+    
+    tilemap.set_tile(21, 0, GRASS)
+    water.disturb_rect(21, 0, 22, 1)
+    steps = 0
+    while water:
+        water.step()
+        steps += 1
+    flooded = grass + 1 - count_grass()
+    print('flooded {} of {} grass tiles in {} steps'.format(flooded, grass + 1, steps))
+    
+    #Every flooded tile is within spread steps of the edit
+    assert steps <= water.spread + 1
+    assert 0 < flooded <= 2 * water.spread * (water.spread + 1) + 1
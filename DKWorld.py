@@ -1,10 +1,23 @@
+from __future__ import division
 import pygame
+import threading
+from array import array
+from collections import OrderedDict
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
-BLACK = (0,   0,   0  )
-BROWN = (153, 76,  0  )
-GREEN = (0,   255, 0  )
-BLUE  = (0,   0,   255)
-WHITE = (255, 255, 255)
+from DKMisc import quick_hash_region
+
+BLACK  = (0,   0,   0  )
+BROWN  = (153, 76,  0  )
+GREEN  = (0,   255, 0  )
+BLUE   = (0,   0,   255)
+WHITE  = (255, 255, 255)
+YELLOW = (255, 255, 0  )
+CYAN   = (0,   255, 255)
+RED    = (255, 0,   0  )
 
 
 DIRT = 0
@@ -20,39 +33,405 @@ TILECOLOURS = {
     COAL  : BLACK
 }
 
-#Test case
-TILEMAP = {
-    (-1, -2): GRASS,
-    ( 0, -2): COAL,
-    ( 1, -2): DIRT,
-    (-1, -1): WATER,
-    ( 0, -1): WATER,
-    ( 1, -1): GRASS,
-    (-1,  0): COAL,
-    ( 0,  0): GRASS,
-    ( 1,  0): WATER,
-    (-1,  1): DIRT,
-    ( 0,  1): GRASS,
-    ( 1,  1): COAL,
-    (-1,  2): GRASS,
-    ( 0,  2): WATER,
-    ( 1,  2): DIRT
-}
-
-#Build a circle
-for x in range(-50, 50):
-    for y in range(-50, 50):
-        if x ** 2 + y ** 2 < 500:
-            TILEMAP[(x, y)] = GRASS
-
 TILESIZE = 40
 DEFAULTTILE = WATER
 
+#Chunks are CHUNK_SIZE x CHUNK_SIZE tiles, must be a power of 2
+CHUNK_SHIFT = 5
+CHUNK_SIZE = 1 << CHUNK_SHIFT
+CHUNK_MASK = CHUNK_SIZE - 1
+
+
+def chunk_coords(x, y=None):
+    """Get the coordinates of the chunk containing a tile.
+    Works for negative numbers since the shift rounds down.
+    """
+    if y is None:
+        x, y = x
+    return (x >> CHUNK_SHIFT, y >> CHUNK_SHIFT)
+
+
+class TileChunk(object):
+    """Square block of tiles stored as a flat array of tile ids.
+
+    The tiles are stored column by column, so the index of a tile is
+    local_x * CHUNK_SIZE + local_y.
+    """
+    __slots__ = ('x', 'y', 'tiles')
+
+    def __init__(self, x, y, default=DEFAULTTILE, tiles=None):
+        """Input the chunk coordinates and the tile to fill it with,
+        or an existing array of tiles.
+        """
+        self.x = x
+        self.y = y
+        if tiles is None:
+            tiles = array('B', [default]) * (CHUNK_SIZE * CHUNK_SIZE)
+        self.tiles = tiles
+
+    def __repr__(self):
+        return 'TileChunk({}, {})'.format(self.x, self.y)
+
+    @property
+    def origin(self):
+        """Get the world coordinates of the top left tile."""
+        return (self.x << CHUNK_SHIFT, self.y << CHUNK_SHIFT)
+
+    def get_tile(self, x, y):
+        """Get a tile from its world coordinates."""
+        return self.tiles[(x & CHUNK_MASK) << CHUNK_SHIFT | (y & CHUNK_MASK)]
+
+    def set_tile(self, x, y, tile):
+        """Set a tile from its world coordinates."""
+        self.tiles[(x & CHUNK_MASK) << CHUNK_SHIFT | (y & CHUNK_MASK)] = tile
+
+
+def chunk_array(chunk):
+    """Get the tiles of a chunk as a numpy array indexed by [x, y].
+    This shares memory with the chunk, so it can be edited directly.
+    """
+    return numpy.frombuffer(chunk.tiles, dtype=numpy.uint8).reshape(CHUNK_SIZE, CHUNK_SIZE)
+
+
+def _value_noise(x, y, width, height, spacing, seed):
+    """Get smooth noise between -1 and 1 for a rectangle of tiles, by
+    blending random values placed every spacing tiles.
+    Requires numpy, and returns an array indexed by [x, y].
+    """
+    lattice_x = x // spacing
+    lattice_y = y // spacing
+    values = quick_hash_region(lattice_x, lattice_y,
+                               (x + width - 1) // spacing - lattice_x + 2,
+                               (y + height - 1) // spacing - lattice_y + 2,
+                               1 << 14, seed) / (1 << 14)
+
+    offset_x = numpy.arange(width) + (x - lattice_x * spacing)
+    offset_y = numpy.arange(height) + (y - lattice_y * spacing)
+    i = offset_x // spacing
+    j = offset_y // spacing
+    fx = (offset_x % spacing / spacing)[:, None]
+    fy = (offset_y % spacing / spacing)[None, :]
+    fx = fx * fx * (3 - 2 * fx)
+    fy = fy * fy * (3 - 2 * fy)
+
+    i, j = i[:, None], j[None, :]
+    top = values[i, j] + (values[i + 1, j] - values[i, j]) * fx
+    bottom = values[i, j + 1] + (values[i + 1, j + 1] - values[i, j + 1]) * fx
+    return top + (bottom - top) * fy
+
+
+class WorldGenerator(object):
+    """Procedural world, where every chunk only depends on the seed and
+    its coordinates, so chunks can be made in any order and made again
+    if they get thrown away.
+
+    Islands of grass are made from noise, with a round island at the
+    origin to start on, and patches of dirt and coal away from it.
+    This is used as a TileMap source, so chunks are only generated the
+    first time they are used.
+    Requires numpy.
+    """
+
+    def __init__(self, seed=0, default=DEFAULTTILE, land_level=0.25, spawn_radius=22):
+        self.seed = seed
+        self.default = default
+        self.land_level = land_level
+        self.spawn_radius = spawn_radius
+
+    def generate(self, chunk_x, chunk_y):
+        """Get the tiles of a chunk as a numpy array indexed by [x, y]."""
+        x = chunk_x << CHUNK_SHIFT
+        y = chunk_y << CHUNK_SHIFT
+        seed = self.seed * 4
+        height = (_value_noise(x, y, CHUNK_SIZE, CHUNK_SIZE, 64, seed) * 0.7
+                  + _value_noise(x, y, CHUNK_SIZE, CHUNK_SIZE, 16, seed + 1) * 0.3)
+
+        #Only chunks near the origin need the spawn island, so the
+        #array maths never sees large coordinates
+        near_x = min(max(0, x), x + CHUNK_SIZE - 1)
+        near_y = min(max(0, y), y + CHUNK_SIZE - 1)
+        if near_x ** 2 + near_y ** 2 < self.spawn_radius ** 2:
+            offsets = numpy.arange(CHUNK_SIZE)
+            tile_x = (offsets + x)[:, None]
+            tile_y = (offsets + y)[None, :]
+            spawn = tile_x ** 2 + tile_y ** 2 < self.spawn_radius ** 2
+        else:
+            spawn = numpy.zeros((CHUNK_SIZE, CHUNK_SIZE), dtype=bool)
+
+        land = spawn | (height > self.land_level)
+        dirt = land & ~spawn & (_value_noise(x, y, CHUNK_SIZE, CHUNK_SIZE, 8, seed + 2) > 0.3)
+        coal = dirt & (quick_hash_region(x, y, CHUNK_SIZE, CHUNK_SIZE, 50, seed + 3) >= 40)
+
+        tiles = numpy.full((CHUNK_SIZE, CHUNK_SIZE), self.default, dtype=numpy.uint8)
+        tiles[land] = GRASS
+        tiles[dirt] = DIRT
+        tiles[coal] = COAL
+        return tiles
+
+    def load_chunk(self, x, y):
+        """Generate a new chunk."""
+        return TileChunk(x, y, tiles=array('B', self.generate(x, y).tobytes()))
+
+
+class TileMap(object):
+    """Infinite world of tiles, split into chunks.
+
+    Chunks are made the first time they are used. They are read from
+    the source if one is loaded, such as a WorldFile, otherwise made
+    by the generator if there is one. Any edited chunks are recorded
+    in dirty so only they need saving.
+
+    With no source or generator, chunks are only created once a tile
+    inside them is set, anything else will return the default tile.
+
+    If cache_size is set, chunks that came from the source or the
+    generator are forgotten when more than that many are loaded,
+    least recently used first, as long as they haven't been edited
+    since being saved. They will just be loaded again if needed.
+
+    Chunks are read from the render thread as well, so lock is held
+    while chunks are added or forgotten, and while a chunk is edited
+    and marked as dirty, so it can't be forgotten part way through.
+    """
+
+    def __init__(self, default=DEFAULTTILE, generator=None, cache_size=None):
+        self.default = default
+        self.chunks = {}
+        self.dirty = set()
+        self.source = None
+        self.generator = generator
+        self.cache_size = cache_size
+        self.loaded = OrderedDict()
+        self.lock = threading.RLock()
+
+    def __getitem__(self, coordinate):
+        return self.get_tile(*coordinate)
+
+    def __setitem__(self, coordinate, tile):
+        self.set_tile(coordinate[0], coordinate[1], tile)
+
+    def reset(self, generator=None, default=DEFAULTTILE):
+        """Forget every chunk and the source, and start again with a
+        new generator.
+        """
+        with self.lock:
+            self.chunks = {}
+            self.dirty = set()
+            self.loaded = OrderedDict()
+            self.source = None
+            self.generator = generator
+            self.default = default
+
+    def load(self, source):
+        """Replace all chunks with ones loaded from a source."""
+        with self.lock:
+            self.chunks = {}
+            self.dirty = set()
+            self.loaded = OrderedDict()
+            self.source = source
+            self.default = source.default
+
+    def load_all(self):
+        """Read every chunk from the source into memory."""
+        if self.source is not None:
+            for key in list(self.source.index):
+                self.get_chunk(*key)
+
+    def get_chunk(self, x, y, create=False):
+        """Get a chunk from its chunk coordinates.
+        Returns None if it doesn't exist, unless create is set.
+        """
+        key = (x, y)
+        with self.lock:
+            chunk = self.chunks.get(key)
+            if chunk is not None:
+                if self.cache_size is not None:
+                    try:
+                        self.loaded[key] = self.loaded.pop(key)
+                    except KeyError:
+                        pass
+                return chunk
+            if self.source is not None:
+                chunk = self.source.load_chunk(x, y)
+        
+        #Generating is slow, so don't hold the lock for it
+        if chunk is None and self.generator is not None:
+            chunk = self.generator.load_chunk(x, y)
+        
+        with self.lock:
+            if chunk is None:
+                if not create:
+                    return None
+                chunk = TileChunk(x, y, self.default)
+                return self.chunks.setdefault(key, chunk)
+            
+            #Another thread may have loaded it first
+            if key in self.chunks:
+                return self.chunks[key]
+            self.chunks[key] = chunk
+            if self.cache_size is not None:
+                self.loaded[key] = None
+                self._evict()
+            return chunk
+
+    def _evict(self):
+        """Forget the least recently used chunks over the cache size.
+        Edited chunks are kept, since they can't be loaded again.
+        """
+        while len(self.loaded) > self.cache_size:
+            try:
+                key = self.loaded.popitem(last=False)[0]
+            except KeyError:
+                return
+            if key not in self.dirty:
+                self.chunks.pop(key, None)
+
+    def get_chunks(self, x_min, y_min, x_max, y_max):
+        """Get every chunk overlapping a range of tiles.
+        The max values are exclusive, the same as range().
+
+        Returns a dict of {(chunk_x, chunk_y): chunk}, where the chunk
+        is None if it hasn't been created.
+        """
+        return {(x, y): self.get_chunk(x, y)
+                for x in range(x_min >> CHUNK_SHIFT, ((x_max - 1) >> CHUNK_SHIFT) + 1)
+                for y in range(y_min >> CHUNK_SHIFT, ((y_max - 1) >> CHUNK_SHIFT) + 1)}
+
+    def _region_overlaps(self, x, y, width, height):
+        """Find which part of each chunk is inside a rectangle.
+        Yields the chunk coordinates, the slices of the region, and the
+        slices of the chunk, for arrays indexed by [x, y].
+        """
+        x_max = x + width
+        y_max = y + height
+        for chunk_x in range(x >> CHUNK_SHIFT, ((x_max - 1) >> CHUNK_SHIFT) + 1):
+            origin_x = chunk_x << CHUNK_SHIFT
+            x1 = max(x, origin_x)
+            x2 = min(x_max, origin_x + CHUNK_SIZE)
+            for chunk_y in range(y >> CHUNK_SHIFT, ((y_max - 1) >> CHUNK_SHIFT) + 1):
+                origin_y = chunk_y << CHUNK_SHIFT
+                y1 = max(y, origin_y)
+                y2 = min(y_max, origin_y + CHUNK_SIZE)
+                yield ((chunk_x, chunk_y),
+                       (slice(x1 - x, x2 - x), slice(y1 - y, y2 - y)),
+                       (slice(x1 - origin_x, x2 - origin_x), slice(y1 - origin_y, y2 - origin_y)))
+
+    def get_tile_region(self, x, y, width, height):
+        """Get the tiles in a rectangle.
+        Requires numpy, and returns an array indexed by [x, y] relative
+        to the top left corner.
+        """
+        region = numpy.full((width, height), self.default, dtype=numpy.uint8)
+        if width <= 0 or height <= 0:
+            return region
+        for key, region_slice, chunk_slice in self._region_overlaps(x, y, width, height):
+            chunk = self.get_chunk(*key)
+            if chunk is not None:
+                region[region_slice] = chunk_array(chunk)[chunk_slice]
+        return region
+
+    def set_tile_region(self, x, y, tiles, mask=None):
+        """Set the tiles in a rectangle from an array indexed by [x, y]
+        relative to the top left corner.
+        If a mask is given, only the tiles where it is True are set.
+        Requires numpy.
+        """
+        tiles = numpy.asarray(tiles, dtype=numpy.uint8)
+        width, height = tiles.shape
+        if width <= 0 or height <= 0:
+            return
+        for key, region_slice, chunk_slice in self._region_overlaps(x, y, width, height):
+            with self.lock:
+                if mask is None:
+                    chunk_array(self.get_chunk(*key, create=True))[chunk_slice] = tiles[region_slice]
+                else:
+                    chunk_mask = mask[region_slice]
+                    if not chunk_mask.any():
+                        continue
+                    chunk_array(self.get_chunk(*key, create=True))[chunk_slice][chunk_mask] = tiles[region_slice][chunk_mask]
+                self.dirty.add(key)
+
+    def fill_region(self, x, y, width, height, tile):
+        """Set every tile in a rectangle to the same tile.
+        Requires numpy.
+        """
+        if width <= 0 or height <= 0:
+            return
+        for key, region_slice, chunk_slice in self._region_overlaps(x, y, width, height):
+            with self.lock:
+                chunk_array(self.get_chunk(*key, create=True))[chunk_slice] = tile
+                self.dirty.add(key)
+
+    def iter_region(self, x, y, width, height):
+        """Iterate over the tiles in a rectangle that aren't the default.
+        Yields (x, y, tile), going through one chunk at a time, and
+        chunks that don't exist are skipped.
+        Requires numpy.
+        """
+        if width <= 0 or height <= 0:
+            return
+        for key, region_slice, chunk_slice in self._region_overlaps(x, y, width, height):
+            chunk = self.get_chunk(*key)
+            if chunk is None:
+                continue
+            tiles = chunk_array(chunk)[chunk_slice]
+            x_offset = x + region_slice[0].start
+            y_offset = y + region_slice[1].start
+            for local_x, local_y in zip(*numpy.nonzero(tiles != self.default)):
+                yield (x_offset + int(local_x), y_offset + int(local_y), int(tiles[local_x, local_y]))
+
+    def get_tile(self, x, y):
+        chunk = self.chunks.get((x >> CHUNK_SHIFT, y >> CHUNK_SHIFT))
+        if chunk is None:
+            if self.source is None and self.generator is None:
+                return self.default
+            chunk = self.get_chunk(x >> CHUNK_SHIFT, y >> CHUNK_SHIFT)
+            if chunk is None:
+                return self.default
+        return chunk.tiles[(x & CHUNK_MASK) << CHUNK_SHIFT | (y & CHUNK_MASK)]
+
+    def set_tile(self, x, y, tile):
+        key = (x >> CHUNK_SHIFT, y >> CHUNK_SHIFT)
+        with self.lock:
+            chunk = self.get_chunk(key[0], key[1], create=True)
+            chunk.tiles[(x & CHUNK_MASK) << CHUNK_SHIFT | (y & CHUNK_MASK)] = tile
+            self.dirty.add(key)
+
+
+#Chunks are generated when first used, and about 1KB each
+TILEMAP = TileMap(DEFAULTTILE, None if numpy is None else WorldGenerator(), cache_size=4096)
+
+
 def get_tile(x, y=None):
-    """Function that can be updated to something better in the future."""
+    """Get the tile at a coordinate."""
     if y is None:
         x, y = x
-    try:
-        return TILEMAP[(x, y)]
-    except KeyError:
-        return DEFAULTTILE
+    return TILEMAP.get_tile(x, y)
+
+def set_tile(x, y, tile=None):
+    """Set the tile at a coordinate.
+    Can also be called as set_tile((x, y), tile).
+    """
+    if tile is None:
+        (x, y), tile = x, y
+    TILEMAP.set_tile(x, y, tile)
+
+def get_tile_region(x, y, width, height):
+    """Get the tiles in a rectangle as a numpy array."""
+    return TILEMAP.get_tile_region(x, y, width, height)
+
+def set_tile_region(x, y, tiles, mask=None):
+    """Set the tiles in a rectangle from a numpy array."""
+    TILEMAP.set_tile_region(x, y, tiles, mask)
+
+def fill_region(x, y, width, height, tile):
+    """Set every tile in a rectangle to the same tile."""
+    TILEMAP.fill_region(x, y, width, height, tile)
+
+def iter_region(x, y, width, height):
+    """Iterate over the tiles in a rectangle that aren't the default."""
+    return TILEMAP.iter_region(x, y, width, height)
+
+def get_chunk(x, y, create=False):
+    """Get a chunk from its chunk coordinates."""
+    return TILEMAP.get_chunk(x, y, create)
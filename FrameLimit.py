@@ -1,33 +1,247 @@
-from __future__ import division
+from __future__ import division, print_function
 import pygame
 import time
 import random
+import json
+from array import array
+try:
+    from time import perf_counter
+except ImportError:
+    perf_counter = time.time
+
+
+class RingBuffer(object):
+    """Fixed size store of the most recent values."""
+    
+    def __init__(self, size):
+        self.size = size
+        self.data = array('d', [0.0]) * size
+        self.index = 0
+        self.count = 0
+    
+    def __len__(self):
+        return self.count
+    
+    def append(self, value):
+        self.data[self.index] = value
+        self.index = (self.index + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+    
+    def values(self):
+        """Get the values from oldest to newest."""
+        if self.count < self.size:
+            return list(self.data[:self.count])
+        return list(self.data[self.index:]) + list(self.data[:self.index])
+    
+    def percentile(self, percent):
+        """Get a percentile using the nearest rank."""
+        values = sorted(self.values())
+        if not values:
+            return 0.0
+        return values[int(round(percent / 100 * (len(values) - 1)))]
+    
+    def histogram(self, edges):
+        """Count how many values are below each edge.
+        The last count is for anything above the last edge.
+        """
+        counts = [0] * (len(edges) + 1)
+        for value in self.values():
+            for i, edge in enumerate(edges):
+                if value < edge:
+                    counts[i] += 1
+                    break
+            else:
+                counts[-1] += 1
+        return counts
+
+
+class _NullPhase(object):
+    """Used when profiling is disabled, so timing a phase costs nothing
+    more than entering an empty with block.
+    """
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        pass
+
+_NULL_PHASE = _NullPhase()
+
+
+class _Phase(object):
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.start = 0
+    
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+    
+    def __exit__(self, *args):
+        self.profiler.current[self.name] += perf_counter() - self.start
+
+
+class FrameProfiler(object):
+    """Time each phase of every frame and keep the last few hundred.
+    
+    Use it with "with profiler.phase('name'):", and call end_frame once
+    per frame. Phases can be nested, and their times include anything
+    nested inside them. All times are stored in milliseconds.
+    """
+    PHASES = ('events', 'dk_core', 'recalculate', 'world_draw', 'flip', 'limit')
+    HISTOGRAM_EDGES = (0.5, 1, 2, 4, 8, 16, 33, 66)
+    
+    def __init__(self, size=600, enabled=False):
+        self.size = size
+        self.enabled = enabled
+        self.buffers = {}
+        self.current = {}
+        self.phases = {}
+        for name in self.PHASES + ('frame',):
+            self._add_phase(name)
+        self.frame_start = perf_counter()
+    
+    def _add_phase(self, name):
+        self.buffers[name] = RingBuffer(self.size)
+        self.current[name] = 0.0
+        self.phases[name] = _Phase(self, name)
+        
+    def phase(self, name):
+        """Get a context manager to time a phase."""
+        if not self.enabled:
+            return _NULL_PHASE
+        try:
+            return self.phases[name]
+        except KeyError:
+            self._add_phase(name)
+            return self.phases[name]
+    
+    def end_frame(self):
+        """Store the times of the frame that just finished."""
+        now = perf_counter()
+        if not self.enabled:
+            self.frame_start = now
+            return
+        self.current['frame'] = now - self.frame_start
+        self.frame_start = now
+        for name, value in self.current.items():
+            self.buffers[name].append(value * 1000)
+            self.current[name] = 0.0
+    
+    def summary(self):
+        """Get the mean and percentiles of each phase."""
+        result = {}
+        for name, buffer in self.buffers.items():
+            values = buffer.values()
+            result[name] = {'mean': sum(values) / len(values) if values else 0.0,
+                            'p50': buffer.percentile(50),
+                            'p90': buffer.percentile(90),
+                            'p99': buffer.percentile(99),
+                            'max': max(values) if values else 0.0}
+        return result
+    
+    def histograms(self):
+        """Get the histogram of each phase, using HISTOGRAM_EDGES."""
+        return {name: buffer.histogram(self.HISTOGRAM_EDGES) for name, buffer in self.buffers.items()}
+    
+    def _names(self):
+        return list(self.PHASES) + sorted(set(self.buffers) - set(self.PHASES) - {'frame'}) + ['frame']
+    
+    def dump_csv(self, path):
+        """Write the time of every phase for each stored frame."""
+        names = self._names()
+        columns = [self.buffers[name].values() for name in names]
+        with open(path, 'w') as f:
+            f.write(','.join(names) + '\n')
+            for row in zip(*columns):
+                f.write(','.join('{:.4f}'.format(value) for value in row) + '\n')
+    
+    def dump_json(self, path):
+        """Write the summary and histograms."""
+        with open(path, 'w') as f:
+            json.dump({'histogram_edges': self.HISTOGRAM_EDGES,
+                       'summary': self.summary(),
+                       'histograms': self.histograms()}, f, indent=2, sort_keys=True)
+    
+    def dump(self, path):
+        """Write to a CSV or JSON file depending on the extension."""
+        if path.lower().endswith('.json'):
+            self.dump_json(path)
+        else:
+            self.dump_csv(path)
+    
+    def draw_overlay(self, surface, font, position=(5, 5)):
+        """Draw the p50 and p99 of each phase onto a surface.
+        Returns the area that was drawn on.
+        """
+        summary = self.summary()
+        lines = ['{:<12}{:>7}{:>7}'.format('ms', 'p50', 'p99')]
+        for name in self._names():
+            lines.append('{:<12}{:>7.2f}{:>7.2f}'.format(name, summary[name]['p50'], summary[name]['p99']))
+        
+        images = [font.render(line, True, (255, 255, 255), (0, 0, 0)) for line in lines]
+        rect = pygame.Rect(position, (max(image.get_width() for image in images),
+                                      sum(image.get_height() for image in images)))
+        y = position[1]
+        for image in images:
+            surface.blit(image, (position[0], y))
+            y += image.get_height()
+        return rect
+
 
 class GameTime(object):
-    def __init__(self, desired_fps=120, desired_ticks=60):
-        self.start_time = time.time()
+    """Fixed timestep scheduler.
+    
+    Real time is added to an accumulator, and is taken off in steps of
+    1 / desired_ticks, so the game logic always runs at the same rate no
+    matter the framerate. alpha is how far through the next tick it is,
+    for blending between the last two ticks when drawing.
+    """
+    MAX_CATCH_UP = 0.25 #Most seconds of ticks to run in one frame after a stall
+    SPIN_TIME = 0.001 #Busy wait for the end of the sleep, as sleep isn't precise
+    
+    def __init__(self, desired_fps=120, desired_ticks=60, profiler=None):
+        self.start_time = perf_counter()
         self.desired_fps = desired_fps
         self.desired_ticks = desired_ticks
+        self.profiler = profiler or FrameProfiler()
         
         self.ticks = 0
+        self.accumulator = 0.0
+        self.alpha = 0.0
+        self.last_time = self.start_time
+        self.frame_end = self.start_time
         
         self.framerate_counter = 1
         self.framerate_time = 0
         
     def calculate_ticks(self, current_time):
-        """Ensure the correct number of ticks have passed since the 
-        start of the game.
+        """Get how many ticks to run this frame.
+        If too much time has passed, such as after the window is dragged,
+        the extra time is dropped instead of running hundreds of ticks.
         This doesn't use the inbuilt pygame ticks.
         """
-        time_elapsed = current_time - self.start_time
+        self.accumulator += current_time - self.last_time
+        self.last_time = current_time
         
-        total_ticks_needed = int(time_elapsed * self.desired_ticks)
+        tick_length = 1 / self.desired_ticks
+        max_ticks = max(1, int(self.desired_ticks * self.MAX_CATCH_UP))
+        self.accumulator = max(0.0, min(self.accumulator, max_ticks * tick_length))
+        ticks_this_frame = min(max_ticks, int(self.accumulator / tick_length))
+        self.accumulator = max(0.0, self.accumulator - ticks_this_frame * tick_length)
+        self.alpha = max(0.0, min(1.0, self.accumulator / tick_length))
         
-        ticks_this_frame = total_ticks_needed - self.ticks
         self.ticks += ticks_this_frame
-        
         return ticks_this_frame
     
+    def skip_time(self):
+        """Ignore the time since the last frame, such as after waiting
+        for input, so no ticks are run for it, and it isn't counted in
+        the frame time of the profiler.
+        """
+        self.last_time = self.frame_end = self.profiler.frame_start = perf_counter()
+    
     def calculate_fps(self, current_time, update_time=0.1):
         """Calculate the FPS from actual time, not ticks.
         
@@ -46,10 +260,29 @@ class GameTime(object):
             return int(fps)
         
     def limit_fps(self, alternate_fps=None):
-        
+        """Wait until the next frame is due.
+        This sleeps for most of the time then spins for the last part,
+        which is much more accurate than sleep on its own.
+        """
         wanted_fps = alternate_fps or self.desired_fps
-        if wanted_fps:
-            pygame.time.Clock().tick(wanted_fps)
+        if not wanted_fps:
+            self.frame_end = perf_counter()
+            return
+        
+        frame_length = 1 / wanted_fps
+        target = self.frame_end + frame_length
+        current_time = perf_counter()
+        
+        #Start again if it's fallen behind instead of rushing frames
+        if target < current_time - frame_length:
+            target = current_time
+        
+        remaining = target - current_time
+        if remaining > self.SPIN_TIME:
+            time.sleep(remaining - self.SPIN_TIME)
+        while perf_counter() < target:
+            pass
+        self.frame_end = target
 
 class GameTimeLoop(object):
     """This gets called every loop but uses GameTime."""
@@ -57,10 +290,11 @@ class GameTimeLoop(object):
     def __init__(self, GTObject):
     
         self.GTObject = GTObject
-        GTObject.loop_start = time.time()
+        GTObject.loop_start = perf_counter()
         
         #Run the code once so the result can be called multiple times
         self.ticks = GTObject.calculate_ticks(GTObject.loop_start)
+        self.alpha = GTObject.alpha
         self.fps = GTObject.calculate_fps(GTObject.loop_start)
         
         self.temp_fps = None
@@ -69,8 +303,14 @@ class GameTimeLoop(object):
         return self
     
     def __exit__(self, *args):
-        self.GTObject.limit_fps(self.temp_fps)
+        with self.GTObject.profiler.phase('limit'):
+            self.GTObject.limit_fps(self.temp_fps)
+        self.GTObject.profiler.end_frame()
         self.temp_fps = None
+    
+    def phase(self, name):
+        """Time part of the frame, see FrameProfiler."""
+        return self.GTObject.profiler.phase(name)
         
     def set_fps(self, fps):
         self.GTObject.desired_fps = fps
@@ -79,7 +319,8 @@ class GameTimeLoop(object):
         self.temp_fps = fps
     
     def update_ticks(self, ticks):
-        self.GTObject.start_time = time.time()
+        self.GTObject.start_time = self.GTObject.last_time = perf_counter()
+        self.GTObject.accumulator = 0.0
         self.GTObject.desired_ticks = ticks
         self.ticks = 0
         
@@ -106,14 +347,15 @@ def game():
             
             #Calculations to be done once per tick
             #Can multiply by the number of ticks or do a loop
+            #frame_time.alpha is how far it is between ticks, for drawing
             ticks_this_frame = frame_time.ticks
-            for tick in xrange(frame_time.ticks):
+            for tick in range(frame_time.ticks):
                 pass
             
             
             #Do normal stuff here
             move_total += move_speed * ticks_this_frame
-            print move_total  #Just print this to show it's correctly staying at the same speed
+            print(move_total)  #Just print this to show it's correctly staying at the same speed
             
             for event in pygame.event.get():
                 if event.type == pygame.QUIT:
@@ -121,7 +363,7 @@ def game():
                 #Set a new fps
                 if event.type == pygame.MOUSEBUTTONDOWN:
                     new_fps = random.choice((None, 1, 5, 10, 30, 60, 120, 1000, 10000))
-                    print 'set fps to: {}'.format(new_fps)
+                    print('set fps to: {}'.format(new_fps))
                     frame_time.set_fps(new_fps)
 
 if __name__ == '__main__':
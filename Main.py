@@ -1,76 +1,139 @@
-from __future__ import division
+from __future__ import division, print_function
+import os
 import time
 import pygame
 import math
 import random
+import numpy
 from operator import itemgetter
 
 from DKWorld import *
 from DKMisc import *
-from FrameLimit import GameTime, GameTimeLoop
+from DKRender import *
+from DKEntity import EntityLayer, ENTITYCOLOURS, ENTITY_RADIUS, IMP
+from DKJobs import JobBoard
+from DKOverview import OverviewPyramid, MAX_LEVEL
+from DKPath import Pathfinder
+from DKRegions import RegionIndex
+from DKReplay import InputRecorder
+from DKSave import load_world, save_world
+from DKSelection import TileSelection, rect_difference
+from DKSim import Simulation, SimulationProcess
+from DKWater import WaterSimulation
+from FrameLimit import FrameProfiler, GameTime, GameTimeLoop
 
         
 class ObjectMovement(object):
-    """Class that can store infinite movement, possibly other stuff later on."""
+    """Class that can store infinite movement, possibly other stuff later on.
+    
+    The position is stored as fixed point integers, in units of 
+    1 / 2 ** FIXED_SHIFT of a tile, so there is no loss of precision
+    no matter how far away it is.
+    """
+    FIXED_SHIFT = 32
+    FIXED_ONE = 1 << FIXED_SHIFT
+    FIXED_MASK = FIXED_ONE - 1
+    DECIMAL_PLACES = 10
     
     def __init__(self, x=0, y=0, speed=100):
         """Input starting location and the max speed."""
-        self.x_int, self.x_float = split_num(x)
-        self.y_int, self.y_float = split_num(y)
+        self.x = self._to_fixed(x)
+        self.y = self._to_fixed(y)
         self.speed = speed
+        self.moved_x = self.moved_y = 0
+        self.step_x = self.step_y = 0
+    
+    def _to_fixed(self, n):
+        """Convert a number of tiles to fixed point."""
+        if isinstance(n, int):
+            return n << self.FIXED_SHIFT
+        return int(round(n * self.FIXED_ONE))
     
-    def _formatstr(self, n_int, n_float):
-        """Convert int and float to a string, needed for large numbers
-        when adding wouldn't work. 
-        (will be moved out of this class later)
+    def _formatstr(self, n):
+        """Convert a fixed point number to a decimal string.
+        The integer part is exact at any size.
         """
-        if n_int < 0:
-            n_str = '-'[n_int != -1:] + str(n_int + 1) + '.' + str(1 - n_float)[2:]
-        else:
-            n_str = str(n_int) + '.' + str(n_float)[2:]
-        return n_str
+        sign = '-' if n < 0 else ''
+        n = abs(n)
+        decimal = str((n & self.FIXED_MASK) * 10 ** self.DECIMAL_PLACES >> self.FIXED_SHIFT)
+        decimal = decimal.zfill(self.DECIMAL_PLACES).rstrip('0') or '0'
+        return '{}{}.{}'.format(sign, n >> self.FIXED_SHIFT, decimal)
     
     def __str__(self):
-        return str((self._formatstr(self.x_int, self.x_float), 
-                    self._formatstr(self.y_int, self.y_float))).replace("'", "")
+        return '({}, {})'.format(self._formatstr(self.x), self._formatstr(self.y))
+    
+    @property
+    def x_int(self):
+        return self.x >> self.FIXED_SHIFT
+    
+    @property
+    def y_int(self):
+        return self.y >> self.FIXED_SHIFT
+    
+    @property
+    def x_float(self):
+        return (self.x & self.FIXED_MASK) / self.FIXED_ONE
+    
+    @property
+    def y_float(self):
+        return (self.y & self.FIXED_MASK) / self.FIXED_ONE
         
     def move(self, x=0, y=0, multiplier=None):
         """Add to the total movement."""
         if multiplier is None:
             multiplier = self.speed
-            
         if x:
-            x_int, x_float = split_num(x * multiplier)
-            self.x_int += x_int
-            self.x_float += x_float
-                
+            x = self._to_fixed(x * multiplier)
+            self.x += x
+            self.moved_x += x
         if y:
-            y_int, y_float = split_num(y * multiplier)
-            self.y_int += y_int
-            self.y_float += y_float
-        
-        self.overflow()
-    
-    def overflow(self):
-        """Overflow the decimal value if above 1."""
-        i = 1 if self.x_float >= 1 else -1
-        while not 0 <= self.x_float < 1:
-            self.x_float -= i
-            self.x_int += i
-        i = 1 if self.y_float >= 1 else -1
-        while not 0 <= self.y_float < 1:
-            self.y_float -= i
-            self.y_int += i
+            y = self._to_fixed(y * multiplier)
+            self.y += y
+            self.moved_y += y
+    
+    def move_ticks(self, x, y, ticks):
+        """Move a number of ticks at a constant speed.
+        The movement of a single tick is kept, which gets blended in 
+        when drawing between ticks.
+        """
+        self.step_x = self._to_fixed(x)
+        self.step_y = self._to_fixed(y)
+        self.move(x, y, ticks)
+    
+    def take_movement(self):
+        """Get the number of tiles moved since the last call."""
+        moved = (self.moved_x / self.FIXED_ONE, self.moved_y / self.FIXED_ONE)
+        self.moved_x = self.moved_y = 0
+        return moved
+    
+    def moving(self):
+        return bool(self.step_x or self.step_y)
+    
+    def pixel_coords(self, tilesize, alpha=None):
+        """Get the position in pixels, rounded down.
+        If alpha is given, the position is blended from the previous
+        step, so it moves smoothly when there are more frames than ticks.
+        """
+        x = self.x
+        y = self.y
+        if alpha is not None and alpha < 1:
+            behind = self.FIXED_ONE - self._to_fixed(alpha)
+            x -= (self.step_x * behind) >> self.FIXED_SHIFT
+            y -= (self.step_y * behind) >> self.FIXED_SHIFT
+        return ((x * tilesize) >> self.FIXED_SHIFT, 
+                (y * tilesize) >> self.FIXED_SHIFT)
     
 class GameData(object):
     """Stuff to do with block selection currently."""
-    BLOCK_TAG = set()
-    BLOCK_TMP = set()
-    BLOCK_TMP_OLD = set()
-    BLOCK_TMP_START = None
-    BLOCK_TMP_END = None
-    BLOCK_TMP_TYPE = 0
-    BLOCK_DATA = {}
+    def __init__(self):
+        self.BLOCK_TAG = TileSelection()
+        self.BLOCK_JOBS = JobBoard(self.BLOCK_TAG)
+        self.BLOCK_TMP = TileSelection()
+        self.BLOCK_TMP_RECT = None
+        self.BLOCK_TMP_START = None
+        self.BLOCK_TMP_END = None
+        self.BLOCK_TMP_TYPE = 0
+        self.BLOCK_DATA = {}
     
     
 class MainGame(object):
@@ -80,101 +143,157 @@ class MainGame(object):
     DEFAULT_TILE = WATER
     TILE_MAX_SIZE = 128
     TILE_MIN_SIZE = 16
-    FPS = None
+    FPS = 120
     TICKS = 120
+    NOISE_SEED = 0
+    WORLD_SEED = 0 #Seed of the generated world, used for any chunks not in WORLD_FILE
+    WORLD_FILE = None #Path to load the world from and save it to (F5)
+    RECORD_FILE = None #Path to record the input to, replay it with benchmark.py --replay
+    SIMULATION_PROCESS = False #Run the ticks in another process, I spawns, right click moves
+    IDLE_TIMEOUT = 500 #Milliseconds to wait for input when nothing is happening
+    PROFILE = False #Time each phase of the frame, F3 shows the times
+    PROFILE_FILE = None #CSV or JSON file to write the times to on exit
+    CHUNK_CACHE_SIZE = 64 * 1024 * 1024 #Memory budget for rendered chunks in bytes
+    OVERVIEW_SCALE = 2 #Pixels per cell of the overview map, M shows it and the wheel changes the level
 
     def recalculate(self):
-        """Update all tiles with new screen dimensions."""
-        overflow = 2 #How many extra blocks to draw around screen
-        try:
-            self.frame_data['Redraw'] = True
-        except AttributeError:
-            pass
-        
-        #Calculate edges of screen
-        x_min = self.cam.x_int + 1 - overflow
-        y_min = self.cam.y_int + 1 - overflow
-        x_max = self.cam.x_int + int(self.WIDTH / self.tilesize) + overflow
-        y_max = self.cam.y_int + int(self.HEIGHT / self.tilesize) + overflow
-        
-        #Build list of all tiles
-        self.screen_coordinates = [(x, y) 
-                                   for x in range(x_min, x_max) 
-                                   for y in range(y_min, y_max)]
-        
-        
-        #Delete the tiles that have gone off screen
-        del_keys = []
-        for key in self.screen_block_data:
-            if not x_min < key[0] < x_max or not y_min < key[1] < y_max:
-                del_keys.append(key)
-        for key in del_keys:
-            del self.screen_block_data[key]
-        
-        
-        #Rebuild the new list of blocks
-        for coordinate in self.screen_coordinates:
-        
-            tile_origin = ((coordinate[0] - self.cam.x_int) - self.cam.x_float, 
-                           (coordinate[1] - self.cam.y_int) - self.cam.y_float)
-            tile_location = tuple(i * self.tilesize for i in tile_origin)
-            
-            if coordinate in self.screen_block_data:
-                #Update existing point with new location
-                self.screen_block_data[coordinate][2] = tile_location
+        """Update the position of the screen after moving or zooming."""
+        with self.profiler.phase('recalculate'):
+            try:
+                self.frame_data['Redraw'] = True
+            except AttributeError:
+                pass
             
-            else:
-                #Generate new point info
-                block_type = get_tile(coordinate)
-                block_hash = quick_hash(*coordinate, offset=self.noise_level)
-                
-                #Get alternate colour based on if the block is tagged
-                #Colours are different for debugging purposes
-                colour_mix = None
-                if self.game_data.BLOCK_TMP_TYPE and coordinate in self.game_data.BLOCK_TMP:
-                    colour_mix = YELLOW
-                elif coordinate in self.game_data.BLOCK_TAG and coordinate not in self.game_data.BLOCK_TMP:
-                    colour_mix = CYAN
-                
-                main_colour = TILECOLOURS[block_type]
-                block_colour = [min(255, max(0, c + block_hash)) for c in main_colour]
-                
-                #Mix alternate colour if required
-                try:
-                    block_colour = [(c + colour_mix[i] * 15) / 16 for i, c in enumerate(block_colour)]
-                except TypeError:
-                    pass
-                
-                self.screen_block_data[coordinate] = [block_type, 
-                                                      block_colour, 
-                                                      tile_location]
+            #Pixel coordinates of the top left corner, the renderer uses
+            #this to work out which part of the screen needs drawing
+            self.screen_position = self.cam.pixel_coords(self.tilesize, self.alpha)
+    
+    def _tag_region(self, x, y, width, height):
+        """Get the tag state of every tile in a rectangle."""
+        tags = numpy.zeros((width, height), dtype=numpy.uint8)
         
+        #Temporary tags are drawn over the existing ones
+        #Colours are different for debugging purposes
+        tmp_state = TAG_TEMP if self.game_data.BLOCK_TMP_TYPE else TAG_NONE
+        tags[self.game_data.BLOCK_TAG.region_array(x, y, width, height)] = TAG_SET
+        tags[self.game_data.BLOCK_TMP.region_array(x, y, width, height)] = tmp_state
+        return tags
+    
+    def _render_region(self, x, y, width, height, tilesize):
+        """Draw a rectangle of tiles to a new surface."""
+        tiles = get_tile_region(x, y, width, height)
+        noise = quick_hash_region(x, y, width, height, self.noise_level, self.NOISE_SEED)
+        tags = self._tag_region(x, y, width, height)
+        return self.palette.render(tiles, noise, tags, tilesize, self.surface_format)
+    
+    def _render_section(self, chunk_x, chunk_y, section_x, section_y, tilesize):
+        """Draw a section of a chunk to a new surface.
+        This is called by the chunk cache if the section isn't stored.
+        """
+        span = section_span(tilesize)
+        return self._render_region(section_x * span, section_y * span, span, span, tilesize)
+    
+    def _zoom_level_sizes(self):
+        """Get the powers of 2 between the min and max tile sizes."""
+        tilesizes = []
+        tilesize = 1
+        while tilesize <= self.TILE_MAX_SIZE:
+            if tilesize >= self.TILE_MIN_SIZE:
+                tilesizes.append(tilesize)
+            tilesize *= 2
+        return tilesizes or [self.TILE_MIN_SIZE]
+    
+    def set_tile(self, x, y, tile):
+        """Edit a tile and redraw it."""
+        set_tile(x, y, tile)
+        self._tiles_edited(x, y, x + 1, y + 1)
     
+    def set_tile_region(self, x, y, tiles, mask=None):
+        """Edit a rectangle of tiles from a numpy array and redraw it.
+        If a mask is given, only the tiles where it is True are set.
+        """
+        width, height = tiles.shape
+        set_tile_region(x, y, tiles, mask)
+        self._tiles_edited(x, y, x + width, y + height)
+    
+    def fill_region(self, x, y, width, height, tile):
+        """Set a rectangle of tiles to the same tile and redraw it."""
+        fill_region(x, y, width, height, tile)
+        self._tiles_edited(x, y, x + width, y + height)
+    
+    def _tiles_edited(self, x_min, y_min, x_max, y_max):
+        """Wake up the water around an edit, and update everything
+        that depends on the tiles.
+        """
+        self.water.disturb_rect(x_min, y_min, x_max, y_max)
+        self._tiles_changed(x_min, y_min, x_max, y_max)
+    
+    def _tiles_changed(self, x_min, y_min, x_max, y_max):
+        """Redraw a rectangle of tiles and forget any paths through it."""
+        self.world_renderer.invalidate_rect(x_min, y_min, x_max, y_max)
+        self.pathfinder.invalidate_rect(x_min, y_min, x_max, y_max)
+        self.regions.invalidate_rect(x_min, y_min, x_max, y_max)
+        self.overview.invalidate_rect(x_min, y_min, x_max, y_max)
+        self.frame_data['Redraw'] = True
+        
     def setscreen(self):
         """Recalculate screen specific things."""
         try:
             self.frame_data['Redraw'] = True
         except AttributeError:
             pass
-        try:
-            self.screen_block_data
-        except AttributeError:
-            self.screen_block_data = {}
         self.mid_point = [self.WIDTH // 2, self.HEIGHT // 2]
         self.screen = pygame.display.set_mode((self.WIDTH, self.HEIGHT), pygame.RESIZABLE | pygame.DOUBLEBUF | pygame.HWSURFACE)
+        
+        #The render thread copies the pixel format from this instead of
+        #the screen, which is replaced when the window is resized
+        self.surface_format = pygame.Surface((1, 1), 0, self.screen)
+        try:
+            self.world_renderer.resize((self.WIDTH, self.HEIGHT), self.screen)
+        except AttributeError:
+            pass
     
-    def play(self):
+    def setup(self):
+        """Initialise the screen and game, and draw the first frame."""
     
         #Initialise screen
         pygame.init()
+        self.profiler = FrameProfiler(enabled=self.PROFILE)
+        self.show_profile = False
+        self.profile_rect = None
+        self.profile_font = pygame.font.SysFont('monospace', 14)
+        self.recorder = None
         self.setscreen()
         
-        #Initialise game
-        GT = GameTime(self.FPS, self.TICKS)
+        #Initialise game, anything left from an earlier game is thrown away
+        TILEMAP.reset(WorldGenerator(self.WORLD_SEED))
+        if self.WORLD_FILE and os.path.exists(self.WORLD_FILE):
+            self.WORLD_SEED = load_world(self.WORLD_FILE).seed
         self.game_data = GameData()
         self.state = 'Main'
         self.tilesize = 20
+        self.alpha = None
         self.noise_level = 15
+        self.palette = TilePalette(TILECOLOURS, self.noise_level, (None, YELLOW, CYAN))
+        self.chunk_cache = ChunkSurfaceCache(self._render_section, self.CHUNK_CACHE_SIZE)
+        self.zoom_levels = ZoomLevels(self._render_region, self._zoom_level_sizes())
+        self.chunk_generator = ChunkGenerator(self.chunk_cache, self._render_section)
+        self.world_renderer = WorldRenderer(self.chunk_cache, self._render_region, self.zoom_levels, 
+                                            generator=self.chunk_generator)
+        self.world_renderer.resize((self.WIDTH, self.HEIGHT), self.screen)
+        self.pathfinder = Pathfinder()
+        self.regions = RegionIndex()
+        self.water = WaterSimulation()
+        self.entities = EntityLayer()
+        self.entity_snapshot = None
+        self.overview = OverviewPyramid(tags=self.game_data.BLOCK_TAG)
+        self.show_overview = False
+        self.overview_drawn = False
+        self.overview_level = 4
+        if self.SIMULATION_PROCESS:
+            self.simulation = SimulationProcess(ticks=self.TICKS)
+        else:
+            self.simulation = Simulation()
         self.screen.fill((255, 255, 255))
         
         #Camera
@@ -184,64 +303,265 @@ class MainGame(object):
         self.recalculate()
         self._world_draw()
         pygame.display.flip()
+    
+    def close(self):
+        """Stop any background work."""
+        self.chunk_generator.stop()
+        if self.SIMULATION_PROCESS:
+            self.simulation.stop()
+        if self.PROFILE_FILE and self.profiler.buffers['frame']:
+            self.profiler.dump(self.PROFILE_FILE)
+        if self.recorder is not None:
+            self.recorder.close()
+    
+    def _sync_entities(self, snapshot):
+        """Update the entity layer from a simulation snapshot."""
+        previous = self.entity_snapshot
+        self.entity_snapshot = snapshot
+        
+        #Only move the entities that changed if nothing was added or removed
+        if previous is not None and previous.shape == snapshot.shape and (previous[:, 0] == snapshot[:, 0]).all():
+            rows = numpy.nonzero((previous[:, 2:] != snapshot[:, 2:]).any(axis=1))[0]
+            for entity_id, kind, x, y in snapshot[rows].tolist():
+                self.entities.move(self.entities.entities[int(entity_id)], x, y)
+            return
+        
+        entities = self.entities.entities
+        ids = set()
+        for entity_id, kind, x, y in snapshot.tolist():
+            entity_id = int(entity_id)
+            ids.add(entity_id)
+            if entity_id in entities:
+                entity = entities[entity_id]
+                if (entity.x, entity.y) != (x, y):
+                    self.entities.move(entity, x, y)
+            else:
+                self.entities.add(int(kind), x, y, entity_id)
+        for entity_id in set(entities) - ids:
+            self.entities.remove(entities[entity_id])
+    
+    def busy(self):
+        """If anything needs updating without any new input."""
+        return bool(self.cam.moving()
+                    or self.water
+                    or self.simulation.moving()
+                    or self.world_renderer.approximate
+                    or self.chunk_generator.pending
+                    or self.game_data.BLOCK_TMP_START is not None
+                    or any(pygame.key.get_pressed())
+                    or any(pygame.mouse.get_pressed()))
+    
+    def wait_for_input(self, game_time):
+        """Sleep until there is an event or the timeout is reached.
+        Returns the event that woke it up.
+        """
+        event = pygame.event.wait(self.IDLE_TIMEOUT)
+        
+        #Don't try to catch up on the time spent waiting
+        game_time.skip_time()
+        if event.type == pygame.NOEVENT:
+            return []
+        return [event]
+    
+    def play(self):
+        self.setup()
+        GT = GameTime(self.FPS, self.TICKS, self.profiler)
+        if self.RECORD_FILE:
+            self.recorder = InputRecorder(self.RECORD_FILE, self.TICKS, self.FPS, 
+                                          (self.WIDTH, self.HEIGHT), self.WORLD_SEED)
         while True:
+            events = []
+            if not pygame.event.peek() and not self.busy():
+                events = self.wait_for_input(GT)
+            
             with GameTimeLoop(GT) as game_time:
             
                 #Store frame specific things so you don't need to call it multiple times
-                self.frame_data = {'Redraw': False,
-                                   'Events': pygame.event.get(),
-                                   'Keys': pygame.key.get_pressed(),
-                                   'MousePos': pygame.mouse.get_pos(),
-                                   'MouseClick': pygame.mouse.get_pressed()}
-                if self.frame_data['Keys'][pygame.K_ESCAPE]:
+                with game_time.phase('events'):
+                    frame_data = {'Redraw': False,
+                                  'Events': events + pygame.event.get(),
+                                  'Keys': pygame.key.get_pressed(),
+                                  'MousePos': pygame.mouse.get_pos(),
+                                  'MouseClick': pygame.mouse.get_pressed()}
+                if self.recorder is not None:
+                    self.recorder.write(frame_data, game_time.ticks, game_time.fps, game_time.alpha)
+                if not self.frame(frame_data, game_time.ticks, game_time.fps, game_time.alpha):
                     pygame.quit()
-                    
-                #Handle quitting and resizing window
-                for event in self.frame_data['Events']:
-                    if event.type == pygame.QUIT:
-                        return
-                    elif event.type == pygame.VIDEORESIZE:
-                        self.WIDTH, self.HEIGHT = event.dict['size']
-                        self.setscreen()
-                        self.recalculate()
-                        
-                #---MAIN LOOP START---#
-                
-                if self.state == 'Main':
-                    self.dk_core(game_time.ticks)
-                
-                
+                    return
+    
+    def frame(self, frame_data, ticks, fps=None, alpha=None):
+        """Run a single frame with the input in frame_data.
+        alpha is how far through the next tick it is, for drawing.
+        Returns False if the game should quit.
+        """
+        self.frame_data = frame_data
+        self.alpha = alpha
+        if self.frame_data['Keys'][pygame.K_ESCAPE]:
+            self.close()
+            return False
+            
+        #Handle quitting and resizing window
+        for event in self.frame_data['Events']:
+            if event.type == pygame.QUIT:
+                self.close()
+                return False
+            elif event.type == pygame.VIDEORESIZE:
+                self.WIDTH, self.HEIGHT = event.dict['size']
+                self.setscreen()
+                self.recalculate()
                 
-                #---MAIN LOOP END---#
-                if game_time.fps:
-                    pygame.display.set_caption('{} {}'.format(game_time.fps, self.cam))
-                    
-                if self.frame_data['Redraw']:
-                    self.screen.fill((0, 0, 0))
-                    self._world_draw()
+        #---MAIN LOOP START---#
+        
+        if self.state == 'Main':
+            with self.profiler.phase('dk_core'):
+                self.dk_core(ticks)
+            
+        #Load chunks in the background in the direction of movement
+        self.chunk_generator.collect()
+        x_moved, y_moved = self.cam.take_movement()
+        if not self.show_overview:
+            self.world_renderer.prefetch(x_moved * self.tilesize, y_moved * self.tilesize, self.tilesize)
+        
+        
+        
+        #---MAIN LOOP END---#
+        if fps:
+            pygame.display.set_caption('{} {}'.format(fps, self.cam))
+            
+            #Update the frame times at the same rate as the FPS
+            if self.show_profile:
+                self.frame_data['Redraw'] = True
+            
+        #Draw the exact zoom once zooming stops
+        if self.world_renderer.pending_redraw():
+            self.frame_data['Redraw'] = True
+        if self.entities.dirty:
+            self.frame_data['Redraw'] = True
+            
+        if self.frame_data['Redraw']:
+            with self.profiler.phase('world_draw'):
+                rects = self._world_draw()
+            rects += self._overlay_draw()
+            with self.profiler.phase('flip'):
+                if self.screen.get_rect() in rects:
                     pygame.display.flip()
+                elif rects:
+                    pygame.display.update(rects)
+        return True
     
     def _world_draw(self):
-        """Draws the world background."""
-        for coordinate in self.screen_coordinates:
-            type, colour, location = self.screen_block_data[coordinate]
-            pygame.draw.rect(self.screen, colour, (location[0], location[1], self.tilesize, self.tilesize))
+        """Draws the world background.
+        Returns the areas of the screen that changed.
+        """
+        if self.show_overview:
+            return self._overview_draw()
+        rects = self.world_renderer.draw(self.screen_position[0], self.screen_position[1], self.tilesize)
+        screen_rect = self.screen.get_rect()
+        
+        #Cover the overview map after it was closed
+        if self.overview_drawn:
+            self.overview_drawn = False
+            rects = [screen_rect]
+        full = screen_rect in rects
+        
+        #Clear where entities used to be
+        for x_min, y_min, x_max, y_max in self.entities.take_dirty():
+            if not full:
+                rect = pygame.Rect(x_min * self.tilesize - self.screen_position[0], 
+                                   y_min * self.tilesize - self.screen_position[1],
+                                   (x_max - x_min) * self.tilesize, 
+                                   (y_max - y_min) * self.tilesize).clip(screen_rect)
+                if rect:
+                    rects.append(rect)
+        
+        for rect in rects:
+            self.screen.blit(self.world_renderer.surface, rect, rect)
+        return rects + self._entity_draw(rects)
     
-    def get_tile_coords(self, coordinates):
-        """Calculate which tile is at the coordinates."""
-        click_segment = [split_num(i / self.tilesize) for i in coordinates]
-        cam_data = ((self.cam.x_int, self.cam.x_float),
-                    (self.cam.y_int, self.cam.y_float))
-        tile = []
-        for i, num in enumerate(cam_data):
-            new_n_int = num[0] + click_segment[i][0]
-            new_n_float = num[1] + click_segment[i][1]
-            while new_n_float > 1:
-                new_n_int += 1
-                new_n_float -= 1
-            tile.append(new_n_int)
-        return tuple(tile)
+    def _overview_draw(self):
+        """Draws the overview map centred on the camera, with a pixel
+        per cell of the current level, scaled up by OVERVIEW_SCALE.
+        Returns the areas of the screen that changed.
+        """
+        cell_size = 1 << self.overview_level
+        centre_x = (self.screen_position[0] + self.mid_point[0]) / (self.tilesize * cell_size)
+        centre_y = (self.screen_position[1] + self.mid_point[1]) / (self.tilesize * cell_size)
+        width = self.WIDTH // self.OVERVIEW_SCALE + 2
+        height = self.HEIGHT // self.OVERVIEW_SCALE + 2
+        left = centre_x - width / 2
+        top = centre_y - height / 2
+        x = int(math.floor(left))
+        y = int(math.floor(top))
+        
+        with self.profiler.phase('overview'):
+            colours = self.overview.render(self.overview_level, x, y, width, height)
+        surface = pygame.transform.scale(pygame.surfarray.make_surface(colours), 
+                                         (width * self.OVERVIEW_SCALE, height * self.OVERVIEW_SCALE))
+        self.screen.blit(surface, (int((x - left) * self.OVERVIEW_SCALE), int((y - top) * self.OVERVIEW_SCALE)))
+        
+        #The whole screen was drawn over the frame times
+        self.profile_rect = None
+        self.overview_drawn = True
+        return [self.screen.get_rect()]
+    
+    def _entity_draw(self, rects):
+        """Draws the entities overlapping the areas that were redrawn.
+        Returns the areas they cover.
+        """
+        drawn = {}
+        for rect in rects:
+            area = self.screen_to_tiles(rect)
+            for entity in self.entities.in_rect(*area):
+                drawn[entity.id] = entity
+        
+        radius = max(1, int(ENTITY_RADIUS * self.tilesize))
+        entity_rects = []
+        for entity in drawn.values():
+            position = (int(entity.x * self.tilesize) - self.screen_position[0],
+                        int(entity.y * self.tilesize) - self.screen_position[1])
+            entity_rects.append(pygame.draw.circle(self.screen, ENTITYCOLOURS[entity.kind], position, radius))
+        return entity_rects
+    
+    def _overlay_draw(self):
+        """Draws the frame times over the world, or removes them if the
+        overlay was turned off.
+        Returns the areas of the screen that changed.
+        """
+        rects = []
         
+        #Cover up the last one in case it was bigger
+        if self.profile_rect is not None:
+            self.screen.blit(self.world_renderer.surface, self.profile_rect, self.profile_rect)
+            rects.append(self.profile_rect)
+            rects += self._entity_draw([self.profile_rect])
+            self.profile_rect = None
+        if self.show_profile:
+            self.profile_rect = self.profiler.draw_overlay(self.screen, self.profile_font)
+            rects.append(self.profile_rect)
+        return rects
+    
+    def screen_to_tiles(self, rect):
+        """Convert a rect on the screen to (x_min, y_min, x_max, y_max)
+        in tiles, which may be fractions.
+        """
+        return ((self.screen_position[0] + rect.left) / self.tilesize,
+                (self.screen_position[1] + rect.top) / self.tilesize,
+                (self.screen_position[0] + rect.right) / self.tilesize,
+                (self.screen_position[1] + rect.bottom) / self.tilesize)
+    
+    def get_entities_at(self, coordinates):
+        """Find which entities are under a point on the screen."""
+        return self.entities.at((self.screen_position[0] + coordinates[0]) / self.tilesize,
+                                (self.screen_position[1] + coordinates[1]) / self.tilesize)
+    
+    def get_tile_coords(self, coordinates):
+        """Calculate which tile is at the coordinates.
+        This uses the drawn position, so clicks land on the tile that
+        was on the screen even when drawing between ticks.
+        """
+        x, y = self.screen_position
+        return ((x + coordinates[0]) // self.tilesize,
+                (y + coordinates[1]) // self.tilesize)
     
     def dk_core(self, num_ticks):
         """Main game function
@@ -256,21 +576,76 @@ class MainGame(object):
             cam_left = -int(self.frame_data['Keys'][pygame.K_a])
             cam_right = int(self.frame_data['Keys'][pygame.K_d])
             
-            if cam_up or cam_down or cam_left or cam_right:
-                self.cam.move(cam_left + cam_right, cam_up + cam_down, num_ticks)
+            #Move a cell at a time on the overview map
+            if self.show_overview:
+                cell_size = 1 << self.overview_level
+                cam_up *= cell_size
+                cam_down *= cell_size
+                cam_left *= cell_size
+                cam_right *= cell_size
+            
+            if cam_up or cam_down or cam_left or cam_right or self.cam.moving():
+                self.cam.move_ticks(cam_left + cam_right, cam_up + cam_down, num_ticks)
                 recalculate = True
         
+        #Keep drawing between ticks while moving
+        elif self.alpha is not None and self.cam.moving():
+            recalculate = True
+        
+        #Let water flow
+        for rect in self.water.update(num_ticks):
+            self._tiles_changed(*rect)
+        
+        #Run the simulation and show the latest state
+        self.simulation.update(num_ticks)
+        latest = self.simulation.latest()
+        if latest is not None:
+            self._sync_entities(latest[1])
+        
         
         
         for event in self.frame_data['Events']:
+            if event.type == pygame.KEYDOWN:
+                if event.key == pygame.K_F5 and self.WORLD_FILE:
+                    save_world(self.WORLD_FILE)
+                
+                #Spawn a unit under the cursor
+                elif event.key == pygame.K_i:
+                    x, y = self.get_tile_coords(self.frame_data['MousePos'])
+                    self.simulation.command('spawn', IMP, x + 0.5, y + 0.5)
+                
+                #Toggle the frame time overlay
+                elif event.key == pygame.K_F3:
+                    self.show_profile = not self.show_profile
+                    self.profiler.enabled = self.show_profile or self.PROFILE
+                    recalculate = True
+                
+                #Toggle the overview map
+                elif event.key == pygame.K_m:
+                    self.show_overview = not self.show_overview
+                    recalculate = True
+                    
             if event.type == pygame.MOUSEBUTTONDOWN:
             
+                #Change the overview level instead of zooming
+                if self.show_overview:
+                    if event.button in (4, 5):
+                        level = self.overview_level + (1 if event.button == 5 else -1)
+                        self.overview_level = max(0, min(level, MAX_LEVEL))
+                        recalculate = True
+                    continue
+            
                 #Click on blocks
                 if event.button == 1:
                     tile_coordinates = self.get_tile_coords(self.frame_data['MousePos'])
                     self.game_data.BLOCK_TMP_START = self.game_data.BLOCK_TMP_END = tile_coordinates
                     self.game_data.BLOCK_TMP_TYPE = tile_coordinates not in self.game_data.BLOCK_TAG
                 
+                #Send units to a tile
+                if event.button == 3:
+                    x, y = self.get_tile_coords(self.frame_data['MousePos'])
+                    self.simulation.command('move_to', x + 0.5, y + 0.5)
+                
                 #Increase zoom
                 if event.button == 4:
                     zoom = 1
@@ -284,49 +659,47 @@ class MainGame(object):
         
             #Commit selection to tag dictionary
             if not self.frame_data['MouseClick'][0]:
-                for i in self.game_data.BLOCK_TMP:
-                    try:
-                        del self.screen_block_data[i]
-                    except KeyError:
-                        pass
+                chunks = self.game_data.BLOCK_TMP.chunks()
+                self.world_renderer.invalidate_chunks(chunks)
+                self.overview.invalidate_chunks(chunks)
                 recalculate = True
                         
                 self.game_data.BLOCK_TMP_START = None
                 if self.game_data.BLOCK_TMP_TYPE:
-                    self.game_data.BLOCK_TAG |= self.game_data.BLOCK_TMP
+                    self.game_data.BLOCK_JOBS.add(self.game_data.BLOCK_TMP)
                 else:
-                    self.game_data.BLOCK_TAG -= self.game_data.BLOCK_TMP
-                self.game_data.BLOCK_TMP = set()
-                self.game_data.BLOCK_TMP_OLD = set()
+                    self.game_data.BLOCK_JOBS.remove(self.game_data.BLOCK_TMP)
+                self.game_data.BLOCK_TMP = TileSelection()
+                self.game_data.BLOCK_TMP_RECT = None
             
             #Show the selection while dragging
             else:
                 tile_coordinates = self.get_tile_coords(self.frame_data['MousePos'])
+                start = self.game_data.BLOCK_TMP_START
                 
                 #Adjust the range depending on which direction the dragging is
-                if tile_coordinates[0] <= self.game_data.BLOCK_TMP_START[0]:
-                    x_range = range(tile_coordinates[0], self.game_data.BLOCK_TMP_START[0] + 1)
-                else:
-                    x_range = range(self.game_data.BLOCK_TMP_START[0], tile_coordinates[0] + 1)
-                if tile_coordinates[1] <= self.game_data.BLOCK_TMP_START[1]:
-                    y_range = range(tile_coordinates[1], self.game_data.BLOCK_TMP_START[1] + 1)
-                else:
-                    y_range = range(self.game_data.BLOCK_TMP_START[1], tile_coordinates[1] + 1)
-                
-                #Rebuild list of blocks
-                self.game_data.BLOCK_TMP = set((x, y) for x in x_range for y in y_range)
-                self.game_data.BLOCK_TMP.add(self.game_data.BLOCK_TMP_START)
+                rect = (min(tile_coordinates[0], start[0]), 
+                        min(tile_coordinates[1], start[1]),
+                        max(tile_coordinates[0], start[0]) + 1, 
+                        max(tile_coordinates[1], start[1]) + 1)
+                old_rect = self.game_data.BLOCK_TMP_RECT
                 
-                #Delete the cached block data for any block updates
-                difference1 = self.game_data.BLOCK_TMP_OLD - self.game_data.BLOCK_TMP
-                difference2 = self.game_data.BLOCK_TMP - self.game_data.BLOCK_TMP_OLD
-                for i in difference1 | difference2:
-                    try:
-                        del self.screen_block_data[i]
-                    except KeyError:
-                        pass
-                recalculate = True
-                self.game_data.BLOCK_TMP_OLD = self.game_data.BLOCK_TMP
+                #Only update the strips that were added or removed
+                if rect != old_rect:
+                    if old_rect is None:
+                        added = [rect]
+                        removed = []
+                    else:
+                        added = rect_difference(rect, old_rect)
+                        removed = rect_difference(old_rect, rect)
+                    for strip in removed:
+                        self.game_data.BLOCK_TMP.remove_rect(*strip)
+                        self.world_renderer.invalidate_rect(*strip)
+                    for strip in added:
+                        self.game_data.BLOCK_TMP.add_rect(*strip)
+                        self.world_renderer.invalidate_rect(*strip)
+                    recalculate = True
+                    self.game_data.BLOCK_TMP_RECT = rect
         
         #Handle zooming and related camera movement
         try:
@@ -401,6 +774,7 @@ class MainGame(object):
         
         
         if self.frame_data['Keys'][pygame.K_c]:
-            print str(self.cam)
+            print(str(self.cam))
     
-MainGame().play()
+if __name__ == '__main__':
+    MainGame().play()
@@ -0,0 +1,220 @@
+"""Run MainGame without a window using scripted input, and time it.
+
+    python benchmark.py
+    python benchmark.py --save baseline.json
+    python benchmark.py --baseline baseline.json
+    python benchmark.py --replay session.dkr --realtime
+"""
+from __future__ import division, print_function
+import argparse
+import json
+import os
+import sys
+
+#Must be set before pygame creates a display
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+import pygame
+
+from DKReplay import InputReplay, ScriptedKeys
+from Main import MainGame
+
+try:
+    from time import perf_counter
+except ImportError:
+    from time import time as perf_counter
+
+
+def _frame(keys=(), events=(), mouse=(640, 360), click=(0, 0, 0)):
+    return {'Redraw': False,
+            'Events': list(events),
+            'Keys': ScriptedKeys(keys),
+            'MousePos': mouse,
+            'MouseClick': click}
+
+def _wheel(button, mouse):
+    return pygame.event.Event(pygame.MOUSEBUTTONDOWN, button=button, pos=mouse)
+
+
+def scenario_pan(game, frames):
+    """Long WASD pans in every direction, including diagonals."""
+    directions = ([pygame.K_d], [pygame.K_s], [pygame.K_a], [pygame.K_w],
+                  [pygame.K_d, pygame.K_s], [pygame.K_a, pygame.K_w])
+    for i in range(frames):
+        yield _frame(keys=directions[i * len(directions) // frames])
+
+def scenario_zoom(game, frames):
+    """Sweep the zoom between TILE_MIN_SIZE and TILE_MAX_SIZE."""
+    button = 5
+    for i in range(frames):
+        if game.tilesize <= game.TILE_MIN_SIZE:
+            button = 4
+        elif game.tilesize >= game.TILE_MAX_SIZE:
+            button = 5
+        mouse = (200 + (i * 37) % 880, 150 + (i * 23) % 420)
+        yield _frame(events=[_wheel(button, mouse)], mouse=mouse)
+
+def scenario_drag(game, frames):
+    """Large drag selections while fully zoomed out."""
+    #Zoom out before the timing starts
+    while game.tilesize > game.TILE_MIN_SIZE:
+        game.frame(_frame(events=[_wheel(5, (640, 360))]), 1)
+
+    width = game.WIDTH - 1
+    height = game.HEIGHT - 1
+    drag_length = max(2, frames // 4)
+    for i in range(frames):
+        step = i % drag_length
+        if step == 0:
+            mouse = (0, 0)
+            yield _frame(events=[pygame.event.Event(pygame.MOUSEBUTTONDOWN, button=1, pos=mouse)],
+                         mouse=mouse, click=(1, 0, 0))
+        elif step == drag_length - 1:
+            yield _frame(mouse=(width, height))
+        else:
+
+            #Go out to the corner and back again
+            progress = 1 - abs(2 * step / drag_length - 1)
+            mouse = (int(width * progress), int(height * min(1, progress * 1.5)))
+            yield _frame(mouse=mouse, click=(1, 0, 0))
+
+SCENARIOS = {
+    'pan': scenario_pan,
+    'zoom': scenario_zoom,
+    'drag': scenario_drag,
+}
+
+
+def percentile(values, percent):
+    """Get a percentile using the nearest rank."""
+    values = sorted(values)
+    if not values:
+        return 0.0
+    index = int(round(percent / 100 * (len(values) - 1)))
+    return values[index]
+
+
+def run_scenario(name, frames, profile=False, replay=None, realtime=False):
+    """Play through a scenario with a new game, or the frames of an
+    InputReplay if one is given.
+    Returns a dict of results, and the phase times if profiling.
+    """
+    game = MainGame()
+    if replay is not None:
+        replay.configure(game)
+    game.setup()
+    frame_times = []
+    try:
+        game.profiler.enabled = profile
+        game.profiler.end_frame()
+        if replay is not None:
+            source = replay.frames(realtime)
+        else:
+            source = ((frame_data, 1, None, None) for frame_data in SCENARIOS[name](game, frames))
+        start = perf_counter()
+        running = True
+        for frame_data, ticks, fps, alpha in source:
+            frame_start = perf_counter()
+            
+            #The game closes itself if the recording quits
+            running = game.frame(frame_data, ticks, fps, alpha)
+            if not running:
+                break
+            frame_times.append(perf_counter() - frame_start)
+            game.profiler.end_frame()
+        total = perf_counter() - start
+    finally:
+        if running:
+            game.close()
+
+    frame_times = [i * 1000 for i in frame_times]
+    return {'frames': len(frame_times),
+            'total_s': total,
+            'fps': len(frame_times) / sum(frame_times) * 1000 if frame_times else 0.0,
+            'mean_ms': sum(frame_times) / len(frame_times) if frame_times else 0.0,
+            'p50_ms': percentile(frame_times, 50),
+            'p90_ms': percentile(frame_times, 90),
+            'p99_ms': percentile(frame_times, 99),
+            'max_ms': max(frame_times) if frame_times else 0.0}, game.profiler
+
+
+def compare(results, baseline, tolerance):
+    """Print the change from a baseline.
+    Returns the names of any scenarios that got slower than the tolerance.
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        try:
+            old = baseline[name]
+        except KeyError:
+            print('{:<6} no baseline'.format(name))
+            continue
+        changes = []
+        slower = False
+        for key in ('p50_ms', 'p90_ms', 'p99_ms'):
+            change = (result[key] - old[key]) / old[key] if old[key] else 0.0
+            changes.append('{} {:+.1%}'.format(key, change))
+            if change > tolerance:
+                slower = True
+        print('{:<6} {}{}'.format(name, '  '.join(changes), '  REGRESSION' if slower else ''))
+        if slower:
+            regressions.append(name)
+    return regressions
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Benchmark MainGame with scripted input.')
+    parser.add_argument('scenarios', nargs='*',
+                        help='scenarios to run from {} (default: all)'.format(', '.join(sorted(SCENARIOS))))
+    parser.add_argument('--frames', type=int, default=600, help='frames per scenario')
+    parser.add_argument('--save', metavar='PATH', help='save the results as a baseline')
+    parser.add_argument('--baseline', metavar='PATH', help='compare against a saved baseline')
+    parser.add_argument('--profile', action='store_true', help='show the time of each phase')
+    parser.add_argument('--tolerance', type=float, default=0.15,
+                        help='allowed slowdown before it counts as a regression (default: 0.15)')
+    parser.add_argument('--replay', metavar='PATH', help='run a recording from RECORD_FILE instead')
+    parser.add_argument('--realtime', action='store_true', help='play the recording at its recorded speed')
+    args = parser.parse_args(args)
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error('unknown scenario: {}'.format(name))
+
+    results = {}
+    print('{:<6} {:>6} {:>8} {:>8} {:>8} {:>8} {:>8}'.format('', 'frames', 'fps', 'p50 ms',
+                                                            'p90 ms', 'p99 ms', 'max ms'))
+    profiles = {}
+    if args.replay:
+        replay = InputReplay(args.replay)
+        runs = [('replay', replay)]
+    else:
+        runs = [(name, None) for name in args.scenarios or sorted(SCENARIOS)]
+    for name, replay in runs:
+        result, profiles[name] = run_scenario(name, args.frames, args.profile, replay, args.realtime)
+        results[name] = result
+        print('{:<6} {frames:>6} {fps:>8.1f} {p50_ms:>8.2f} {p90_ms:>8.2f} {p99_ms:>8.2f} {max_ms:>8.2f}'.format(
+              name, **result))
+    
+    if args.profile:
+        for name, profiler in sorted(profiles.items()):
+            print()
+            print('{:<12} {:>8} {:>8} {:>8}'.format(name, 'p50 ms', 'p99 ms', 'max ms'))
+            summary = profiler.summary()
+            for phase in ('dk_core', 'recalculate', 'world_draw', 'flip'):
+                print('{:<12} {p50:>8.2f} {p99:>8.2f} {max:>8.2f}'.format(phase, **summary[phase]))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print()
+        if compare(results, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())